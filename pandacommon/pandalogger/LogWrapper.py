@@ -1,6 +1,10 @@
+import collections
 import datetime
+import logging
 import resource
+import time
 
+from . import PandaLogger as PandaLoggerModule
 from .PandaLogger import PandaLogger
 
 
@@ -14,8 +18,8 @@ class LogWrapper:
             self.prefix = prefix
         # logger instance
         self.logger = log
-        # message buffer
-        self.msg_buffer = []
+        # message buffer of (timestamp, message, arguments), dropping the oldest when full
+        self.msg_buffer = collections.deque(maxlen=lineLimit + 1)
         self.line_limit = lineLimit
         # token for monitor
         if monToken is not None:
@@ -28,117 +32,99 @@ class LogWrapper:
             self.name = self.logger.name.split(".")[-1]
         except Exception:
             self.name = ""
+        # pre-serialised context for JSON log format
+        self.json_context = None
+        self.json_context_prefix = None
 
     # get memory usage
     def getMemoryUsage(self):
         return " (mem usage {0} MB)".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024)
 
-    def keepMsg(self, msg):
-        # keep max message depth
-        if len(self.msg_buffer) > self.line_limit:
-            self.msg_buffer.pop(0)
-        timeNow = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
-        self.msg_buffer.append("{0} : {1}".format(timeNow.isoformat(" "), msg))
+    def keepMsg(self, msg, args=()):
+        # formatted lazily in dumpToString
+        self.msg_buffer.append((time.time(), msg, args))
 
-    def debug(self, msg):
-        msg = str(msg)
-        self.keepMsg(msg)
+    # format message with %-style arguments
+    @staticmethod
+    def formatMsg(msg, args):
+        if not args:
+            return str(msg)
         try:
-            if self.hook is not None:
-                self.hook.add_dialog_message(msg, "DEBUG", self.name, self.prefix)
+            return str(msg) % args
         except Exception:
-            pass
-        if self.prefix != "":
-            msg = self.prefix + " " + str(msg)
-        if self.see_mem:
-            msg += self.getMemoryUsage()
-        self.logger.debug(msg)
+            return "{0} {1}".format(msg, args)
 
-    def info(self, msg):
-        msg = str(msg)
-        self.keepMsg(msg)
+    # log a message if the level is enabled; formatting is skipped otherwise
+    def _log(self, level, level_name, msg, args):
+        self.keepMsg(msg, args)
+        if self.hook is None and not self.logger.isEnabledFor(level):
+            return
+        template = msg
+        msg = self.formatMsg(msg, args)
         try:
             if self.hook is not None:
-                self.hook.add_dialog_message(msg, "INFO", self.name, self.prefix)
+                self.hook.add_dialog_message(msg, level_name, self.name, self.prefix)
         except Exception:
             pass
-        if self.prefix != "":
-            msg = self.prefix + " " + str(msg)
+        if not self.logger.isEnabledFor(level):
+            return
         if self.see_mem:
             msg += self.getMemoryUsage()
-        self.logger.info(msg)
+        # template for rate limiting
+        extra = {"panda_template": template}
+        if PandaLoggerModule.logFormat == PandaLoggerModule.JSON:
+            # prefix as a field instead of a part of the message
+            extra["panda_context"] = self.getJsonContext()
+        elif self.prefix != "":
+            msg = self.prefix + " " + msg
+        self.logger.log(level, msg, extra=extra)
 
-    def error(self, msg):
-        msg = str(msg)
-        self.keepMsg(msg)
-        try:
-            if self.hook is not None:
-                self.hook.add_dialog_message(msg, "ERROR", self.name, self.prefix)
-        except Exception:
-            pass
-        if self.prefix != "":
-            msg = self.prefix + " " + str(msg)
-        if self.see_mem:
-            msg += self.getMemoryUsage()
-        self.logger.error(msg)
+    # get pre-serialised context, made again only when the prefix is changed
+    def getJsonContext(self):
+        if self.json_context is None or self.json_context_prefix != self.prefix:
+            self.json_context = PandaLoggerModule.makeJsonContext({"prefix": self.prefix, "component": self.name})
+            self.json_context_prefix = self.prefix
+        return self.json_context
 
-    def warning(self, msg):
-        msg = str(msg)
-        self.keepMsg(msg)
-        try:
-            if self.hook is not None:
-                self.hook.add_dialog_message(msg, "WARNING", self.name, self.prefix)
-        except Exception:
-            pass
-        if self.prefix != "":
-            msg = self.prefix + " " + str(msg)
-        if self.see_mem:
-            msg += self.getMemoryUsage()
-        self.logger.warning(msg)
+    def debug(self, msg, *args):
+        self._log(logging.DEBUG, "DEBUG", msg, args)
 
-    def critical(self, msg):
-        msg = str(msg)
-        self.keepMsg(msg)
-        try:
-            if self.hook is not None:
-                self.hook.add_dialog_message(msg, "CRITICAL", self.name, self.prefix)
-        except Exception:
-            pass
-        if self.prefix != "":
-            msg = self.prefix + " " + str(msg)
-        if self.see_mem:
-            msg += self.getMemoryUsage()
-        self.logger.critical(msg)
+    def info(self, msg, *args):
+        self._log(logging.INFO, "INFO", msg, args)
+
+    def error(self, msg, *args):
+        self._log(logging.ERROR, "ERROR", msg, args)
+
+    def warning(self, msg, *args):
+        self._log(logging.WARNING, "WARNING", msg, args)
+
+    def critical(self, msg, *args):
+        self._log(logging.CRITICAL, "CRITICAL", msg, args)
 
     def dumpToString(self):
         str_msg = ""
-        for msg in self.msg_buffer:
-            str_msg += msg
+        for timestamp, msg, args in self.msg_buffer:
+            timeNow = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).replace(tzinfo=None)
+            str_msg += "{0} : {1}".format(timeNow.isoformat(" "), self.formatMsg(msg, args))
             str_msg += "\n"
         return str_msg
 
-    # send message to logger
+    # send message to logger; parameters travel on the record so that no lock is needed
     def sendMsg(self, message, logger_name, msg_type, msgLevel="info"):
         try:
             # get logger
-            tmp_panda_logger = PandaLogger()
-            # lock HTTP handler
-            tmp_panda_logger.lock()
-            tmp_panda_logger.setParams({"Type": msg_type})
-            # get logger
+            tmp_panda_logger = PandaLogger(type=msg_type)
             tmp_logger = tmp_panda_logger.getHttpLogger(logger_name)
             # add message
             message = self.mon_token + " " + message
+            extra = {"panda_params": tmp_panda_logger.params}
             if msgLevel == "error":
-                tmp_logger.error(message)
+                tmp_logger.error(message, extra=extra)
             elif msgLevel == "warning":
-                tmp_logger.warning(message)
+                tmp_logger.warning(message, extra=extra)
             elif msgLevel == "info":
-                tmp_logger.info(message)
+                tmp_logger.info(message, extra=extra)
             else:
-                tmp_logger.debug(message)
+                tmp_logger.debug(message, extra=extra)
         except Exception:
             pass
-        finally:
-            # release HTTP handler
-            tmp_panda_logger.release()
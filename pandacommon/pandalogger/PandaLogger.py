@@ -1,11 +1,14 @@
+import atexit
 import json
 import logging
 import logging.handlers
 import os
+import queue
 import threading
 import time
 
 from . import logger_config
+from .logger_filters import RateLimitFilter
 
 try:
     import http.client as httplib
@@ -15,6 +18,10 @@ try:
     from urllib.parse import urlencode
 except ImportError:
     from urllib import urlencode
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 # encodings
@@ -27,11 +34,77 @@ os.environ["TZ"] = "UTC"
 # log rotation
 rotateLog = False
 
+# log format; text or json
+logFormat = logger_config.daemon.get("log_format", "text")
+
+
+# serialise an object to JSON string with the fastest encoder available
+if orjson is not None:
+
+    def toJson(obj):
+        return orjson.dumps(obj).decode("utf-8")
+
+else:
+    toJson = json.dumps
+
+
+# pre-serialise a dict into a JSON fragment without braces, to be spliced into JSON records
+def makeJsonContext(context):
+    return ",".join("{0}:{1}".format(toJson(str(key)), toJson(val)) for key, val in context.items())
+
+
+# formatter to make a JSON line per record
+class _JsonFormatter(logging.Formatter):
+    def __init__(self):
+        logging.Formatter.__init__(self)
+        # cache of (second, timestamp string) for the last second, replaced as a whole since the formatter is shared by threads
+        self.lastTime = (None, None)
+
+    def formatTimestamp(self, record):
+        second = int(record.created)
+        last_second, time_str = self.lastTime
+        if second != last_second:
+            time_str = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+            self.lastTime = (second, time_str)
+        return '"{0}.{1:03d}Z"'.format(time_str, int(record.msecs))
+
+    def format(self, record):
+        return self.formatJson(record)
+
+    def formatJson(self, record, context=None):
+        """
+        Make a JSON string with the record fields and pre-serialised contexts from the record and the caller
+        """
+        message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            message += "\n" + record.exc_text
+        if record.stack_info:
+            message += "\n" + self.formatStack(record.stack_info)
+        fragments = [
+            '{{"timestamp":{0},"level":"{1}","logger":{2},"message":{3}'.format(
+                self.formatTimestamp(record), record.levelname, toJson(record.name), toJson(message)
+            )
+        ]
+        record_context = getattr(record, "panda_context", None)
+        if record_context:
+            fragments.append(record_context)
+        if context:
+            fragments.append(context)
+        return ",".join(fragments) + "}"
+
+
 # logger map
 loggerMap = {}
 loggerMapLock = threading.Lock()
 
 
+# handler map keyed by (logdir, log name, rotating policy, file logging mode) to avoid duplication of file handlers
+handlerMap = {}
+handlerMapLock = threading.Lock()
+
+
 # wrapper to avoid duplication of loggers with the same name
 def getLoggerWrapper(logger_name, checkNew=False):
     loggerMapLock.acquire()
@@ -47,52 +120,291 @@ def getLoggerWrapper(logger_name, checkNew=False):
     return loggerMap[logger_name]
 
 
-# a thread to send a record to a web server
-class _Emitter(threading.Thread):
+# a thread to ship records to a web server in batches over a persistent connection
+class _Shipper(threading.Thread):
     # constructor
-    def __init__(self, host, port, url, method, data, semaphore):
-        threading.Thread.__init__(self)
-        self.host = host
-        self.port = port
-        self.url = url
-        self.method = method
-        self.data = data
-        self.semaphore = semaphore
-
-    def getData(self, src, chunk_size=1024):
+    def __init__(self, handler):
+        threading.Thread.__init__(self, name="PandaLogShipper-{0}".format(handler.host))
+        self.daemon = True
+        self.handler = handler
+        self.connection = None
+        # time until when the endpoint is regarded as down
+        self.downUntil = 0
+        # time of the next attempt to replay spooled records
+        self.nextDrainTime = 0
+
+    def getConnection(self):
+        if self.connection is None:
+            self.connection = httplib.HTTPConnection(self.handler.host, self.handler.port, timeout=self.handler.timeout)
+        return self.connection
+
+    def closeConnection(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+    def request(self, data):
+        """
+        Send data and read the response to keep the connection reusable.
+        Retry once on a fresh connection since the server may close idle keep-alive connections
+        """
+        url = self.handler.urlprefix
+        if self.handler.method == "GET":
+            if url.find("?") >= 0:
+                sep = "&"
+            else:
+                sep = "?"
+            url = url + "%c%s" % (sep, data)
+        else:
+            data = data.encode("utf-8")
+        for i_try in range(2):
+            try:
+                connection = self.getConnection()
+                connection.putrequest(self.handler.method, url)
+                if self.handler.method == "POST":
+                    connection.putheader("Content-length", str(len(data)))
+                    connection.putheader("Content-type", "application/json; charset=UTF-8")
+                connection.endheaders()
+                if self.handler.method == "POST":
+                    connection.send(data)
+                connection.getresponse().read()
+                return True
+            except Exception:
+                self.closeConnection()
+        return False
+
+    def ship(self, items):
         """
-        Use this function for debug purposes in order to print
-        out the response from the server
+        Ship items; JSON items go in a single POST as an array, URL-encoded ones one per request
+        return list of items failed
         """
-        data = src.read(chunk_size)
-        while data:
-            yield data
-            data = src.read(chunk_size)
+        if self.handler.encoding == JSON:
+            # items are pre-serialised
+            if self.request("[" + ",".join(item if isinstance(item, str) else json.dumps(item) for item in items) + "]"):
+                return []
+            return items
+        for i_item, data in enumerate(items):
+            if not self.request(data):
+                # the endpoint is unlikely to accept the rest
+                return items[i_item:]
+        return []
+
+    def shipOrSpool(self, items):
+        """
+        Ship items, or spool them while the endpoint is down
+        """
+        handler = self.handler
+        spool = handler.spool
+        if spool is not None and time.monotonic() < self.downUntil:
+            failed_items = items
+        else:
+            try:
+                failed_items = self.ship(items)
+            except Exception:
+                failed_items = items
+            if failed_items and spool is not None:
+                self.downUntil = time.monotonic() + spool.retry_interval
+        n_spooled = 0
+        if failed_items and spool is not None:
+            try:
+                spool.append(failed_items)
+                n_spooled = len(failed_items)
+            except Exception:
+                pass
+        with handler.statsLock:
+            handler.nShipped += len(items) - len(failed_items)
+            handler.nSpooled += n_spooled
+            handler.nDropped += len(failed_items) - n_spooled
+
+    def drain(self):
+        """
+        Replay one spooled segment in batches once the endpoint is back
+        """
+        handler = self.handler
+        spool = handler.spool
+        time_now = time.monotonic()
+        if time_now < self.downUntil or time_now < self.nextDrainTime:
+            return
+        self.nextDrainTime = time_now + spool.drain_interval
+        seg_path = spool.claim()
+        if seg_path is None:
+            return
+        items = spool.read(seg_path)
+        n_replayed = 0
+        for i_item in range(0, len(items), handler.batch_size):
+            batch = items[i_item : i_item + handler.batch_size]
+            try:
+                failed_items = self.ship(batch)
+            except Exception:
+                failed_items = batch
+            n_replayed += len(batch) - len(failed_items)
+            if failed_items:
+                # put back the rest and wait for recovery
+                spool.append(failed_items + items[i_item + handler.batch_size :])
+                self.downUntil = time.monotonic() + spool.retry_interval
+                break
+        else:
+            # go on with the next segment soon
+            self.nextDrainTime = time.monotonic()
+        spool.remove(seg_path)
+        with handler.statsLock:
+            handler.nReplayed += n_replayed
 
     # main
     def run(self):
-        # send the record to the Web server as an URL-encoded dictionary
-        try:
-            connection = httplib.HTTPConnection(self.host, self.port, timeout=1)
-            url = self.url
-            if self.method == "GET":
-                if url.find("?") >= 0:
-                    sep = "&"
+        handler = self.handler
+        if handler.spool is not None:
+            idle_timeout = handler.spool.drain_interval
+        else:
+            idle_timeout = 60
+        while True:
+            try:
+                item = handler.queue.get(timeout=idle_timeout)
+            except queue.Empty:
+                if handler.spool is not None:
+                    self.drain()
                 else:
-                    sep = "?"
-                url = url + "%c%s" % (sep, self.data)
-            connection.putrequest(self.method, url)
-            if self.method == "POST":
-                connection.putheader("Content-length", str(len(self.data)))
-                connection.putheader("Content-type", "application/json; charset=UTF-8")
-            connection.endheaders()
-            if self.method == "POST":
-                connection.send(self.data)
-            connection.getresponse()
+                    # drop idle connection
+                    self.closeConnection()
+                continue
+            items = [item]
+            while len(items) < handler.batch_size:
+                try:
+                    items.append(handler.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.shipOrSpool(items)
+            for _ in items:
+                handler.queue.task_done()
+            if handler.spool is not None:
+                self.drain()
+
+
+# append-only segmented spool on disk for records which could not be shipped
+class _Spool:
+    # constructor
+    def __init__(self, spool_dir, segment_size, retention, retry_interval=30, drain_interval=5):
+        self.spool_dir = spool_dir
+        # max bytes of a segment
+        self.segment_size = segment_size
+        # seconds to keep segments
+        self.retention = retention
+        # seconds to wait before shipping again after a failure
+        self.retry_interval = retry_interval
+        # seconds between attempts to replay segments
+        self.drain_interval = drain_interval
+        self.lock = threading.Lock()
+        self.file = None
+        self.filePath = None
+        self.filePid = None
+        self.seq = 0
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+    def closeSegment(self):
+        """
+        Close the segment being written, making it visible to drainers
+        """
+        if self.file is None:
+            return
+        try:
+            is_empty = self.file.tell() == 0
+            self.file.close()
+            if is_empty:
+                os.remove(self.filePath)
+            else:
+                os.rename(self.filePath, self.filePath[: -len(".open")] + ".seg")
+        except Exception:
+            pass
+        self.file = None
+        self.filePath = None
+
+    def append(self, items):
+        """
+        Append items to the segment being written, one JSON line per item
+        """
+        with self.lock:
+            pid = os.getpid()
+            if self.file is not None and self.filePid != pid:
+                # inherited from parent process
+                self.file = None
+            if self.file is not None and self.file.tell() >= self.segment_size:
+                self.closeSegment()
+            if self.file is None:
+                self.seq += 1
+                self.filePath = os.path.join(self.spool_dir, "{0}-{1}-{2:06d}.open".format(time.strftime("%Y%m%d%H%M%S"), pid, self.seq))
+                self.file = open(self.filePath, "a", encoding="utf-8")
+                self.filePid = pid
+            self.file.write("".join(json.dumps(item) + "\n" for item in items))
+            self.file.flush()
+
+    def claim(self):
+        """
+        Claim the oldest segment to replay, expiring old ones and recovering segments of dead processes
+        return path of the claimed segment or None
+        """
+        with self.lock:
+            if self.file is not None and self.filePid == os.getpid():
+                self.closeSegment()
+        time_limit = time.time() - self.retention
+        for file_name in sorted(os.listdir(self.spool_dir)):
+            file_path = os.path.join(self.spool_dir, file_name)
+            try:
+                if os.path.getmtime(file_path) < time_limit:
+                    os.remove(file_path)
+                    continue
+                if ".drain-" in file_name:
+                    # segment being replayed, or left by a process which died while replaying it
+                    pid = int(file_name.rsplit(".drain-", 1)[1])
+                    if pid == os.getpid() or _isAlive(pid):
+                        continue
+                elif file_name.endswith(".open"):
+                    # segment left by a dead process
+                    pid = int(file_name.split("-")[1])
+                    if pid == os.getpid() or _isAlive(pid):
+                        continue
+                elif not file_name.endswith(".seg"):
+                    continue
+                claimed_path = "{0}.drain-{1}".format(file_path.split(".drain-")[0], os.getpid())
+                os.rename(file_path, claimed_path)
+                return claimed_path
+            except Exception:
+                # taken by another process
+                continue
+        return None
+
+    def read(self, file_path):
+        items = []
+        try:
+            with open(file_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        items.append(json.loads(line))
+                    except ValueError:
+                        # truncated line
+                        pass
+        except Exception:
+            pass
+        return items
 
+    def remove(self, file_path):
+        try:
+            os.remove(file_path)
         except Exception:
             pass
-        self.semaphore.release()
+
+
+# check if a process is alive
+def _isAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except Exception:
+        pass
+    return True
 
 
 class _PandaHTTPLogHandler(logging.Handler):
@@ -120,13 +432,56 @@ class _PandaHTTPLogHandler(logging.Handler):
         self.encoding = encoding
         # create lock for params, cannot use createLock()
         self.mylock = threading.Lock()
-        # semaphore to limit the number of concurrent emitters
-        if "nemitters" in logger_config.daemon:
-            self.my_semaphore = threading.Semaphore(int(logger_config.daemon["nemitters"]))
+        # max number of records waiting to be shipped
+        if "ship_queue_size" in logger_config.daemon:
+            self.queue_size = int(logger_config.daemon["ship_queue_size"])
+        else:
+            self.queue_size = 10000
+        # max number of records shipped at once
+        if "ship_batch_size" in logger_config.daemon:
+            self.batch_size = int(logger_config.daemon["ship_batch_size"])
         else:
-            self.my_semaphore = threading.Semaphore(10)
+            self.batch_size = 100
+        # timeout in seconds for connections
+        self.timeout = 1
+        # statistics
+        self.statsLock = threading.Lock()
+        self.nShipped = 0
+        self.nDropped = 0
+        self.nSpooled = 0
+        self.nReplayed = 0
+        # spool on disk for records which cannot be shipped
+        self.spool = None
+        if logger_config.daemon.get("spool") == "True":
+            # segment size in MB
+            if "spool_segment_size" in logger_config.daemon:
+                segment_size = int(logger_config.daemon["spool_segment_size"])
+            else:
+                segment_size = 16
+            # retention in hours
+            if "spool_retention" in logger_config.daemon:
+                retention = int(logger_config.daemon["spool_retention"])
+            else:
+                retention = 24
+            try:
+                self.spool = _Spool(
+                    os.path.join(logger_config.daemon["logdir"], "spool", "{0}_{1}".format(host, port)),
+                    segment_size * 1024 * 1024,
+                    retention * 60 * 60,
+                )
+            except Exception:
+                pass
+        # queue and shipper thread, created lazily per process since threads do not survive fork
+        self.queue = None
+        self.shipper = None
+        self.shipperPid = None
         # parameters
         self.params = {"PandaID": -1, "User": "unknown", "Type": "unknown", "ID": "tester"}
+        # pre-serialised parameters and host for JSON records
+        self.paramsContext = makeJsonContext(self.params)
+        self.hostJson = toJson("%s:%s" % (self.url, self.port))
+        # formatter for JSON log format
+        self.jsonFormatter = _JsonFormatter()
 
     def mapLogRecord(self, record):
         """
@@ -134,9 +489,12 @@ class _PandaHTTPLogHandler(logging.Handler):
         that is sent as the CGI data. Overwrite in your class.
         Contributed by Franz  Glasner.
         """
-        newrec = record.__dict__
-        for p in self.params:
-            newrec[p] = self.params[p]
+        # copy not to leak parameters into the record shared with other handlers
+        newrec = dict(record.__dict__)
+        newrec.pop("panda_params", None)
+        params = self.getRecordParams(record)
+        for p in params:
+            newrec[p] = params[p]
         maxParamLength = 4000
         # truncate and clean the message from non-UTF-8 characters
         try:
@@ -160,27 +518,85 @@ class _PandaHTTPLogHandler(logging.Handler):
         # The new logger needs to be json encoded and use POST method
         try:
             if self.encoding == JSON:
-                arr = [
-                    {
-                        "headers": {"timestamp": int(time.time()) * 1000, "host": "%s:%s" % (self.url, self.port)},
-                        "body": "{0}".format(json.dumps(self.mapLogRecord(record))),
-                    }
-                ]
-                data = json.dumps(arr)
+                if logFormat == JSON:
+                    # only selected fields with pre-serialised parameters
+                    if getattr(record, "panda_params", None):
+                        params_context = makeJsonContext(self.getRecordParams(record))
+                    else:
+                        params_context = self.paramsContext
+                    body = self.jsonFormatter.formatJson(record, params_context)
+                else:
+                    body = json.dumps(self.mapLogRecord(record))
+                # serialise once here so that the shipper only joins items into an array
+                data = '{{"headers":{{"timestamp":{0},"host":{1}}},"body":{2}}}'.format(int(time.time()) * 1000, self.hostJson, toJson(body))
             else:
                 data = urlencode(self.mapLogRecord(record))
-
-            # try to lock Semaphore
-            if self.my_semaphore.acquire(False):
-                # start Emitter
-                _Emitter(self.host, self.port, self.urlprefix, self.method, data, self.my_semaphore).start()
         except UnicodeDecodeError:
             # We lose the message
-            pass
+            self.countDropped()
+            return
+        # hand over to the shipper without blocking the caller
+        try:
+            self.getQueue().put_nowait(data)
+        except queue.Full:
+            self.countDropped()
+
+    def getQueue(self):
+        """
+        Get the queue, starting the shipper thread if it is not running in this process
+        """
+        pid = os.getpid()
+        if self.shipperPid != pid:
+            with self.statsLock:
+                if self.shipperPid != pid:
+                    self.queue = queue.Queue(self.queue_size)
+                    self.shipper = _Shipper(self)
+                    self.shipper.start()
+                    self.shipperPid = pid
+        return self.queue
+
+    def countDropped(self, n=1):
+        with self.statsLock:
+            self.nDropped += n
+
+    def getStats(self):
+        """
+        Get statistics of the handler
+        """
+        with self.statsLock:
+            return {
+                "shipped": self.nShipped,
+                "dropped": self.nDropped,
+                "spooled": self.nSpooled,
+                "replayed": self.nReplayed,
+                "queued": self.queue.qsize() if self.queue is not None and self.shipperPid == os.getpid() else 0,
+            }
+
+    def flush(self, timeout=1):
+        """
+        Wait for a while until queued records are shipped
+        """
+        if self.queue is None or self.shipperPid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
 
     def setParams(self, params):
         for pname in params.keys():
             self.params[pname] = params[pname]
+        self.paramsContext = makeJsonContext(self.params)
+
+    def getRecordParams(self, record):
+        """
+        Get parameters of the handler overridden by per-record ones given as extra={"panda_params": {...}}
+        """
+        record_params = getattr(record, "panda_params", None)
+        if not record_params:
+            return self.params
+        params = dict(self.params)
+        params.update(record_params)
+        return params
 
     # acquire lock
     def lockHandler(self):
@@ -194,6 +610,151 @@ class _PandaHTTPLogHandler(logging.Handler):
             pass
 
 
+# file handlers which leave flush to the async writer
+class _DeferredFlushMixin:
+    # buffer size of files
+    bufferSize = 1024 * 1024
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=self.bufferSize, encoding=self.encoding, errors=self.errors)
+
+    def flush(self):
+        # flushed by the writer thread after each batch
+        pass
+
+    def flushBuffer(self):
+        logging.StreamHandler.flush(self)
+
+    def close(self):
+        self.flushBuffer()
+        super().close()
+
+
+class _AsyncFileHandler(_DeferredFlushMixin, logging.FileHandler):
+    pass
+
+
+class _AsyncRotatingFileHandler(_DeferredFlushMixin, logging.handlers.RotatingFileHandler):
+    pass
+
+
+class _AsyncTimedRotatingFileHandler(_DeferredFlushMixin, logging.handlers.TimedRotatingFileHandler):
+    pass
+
+
+# a thread to write records of all async file handlers in the process
+class _AsyncFileWriter(threading.Thread):
+    # max number of records written before flush
+    batchSize = 1000
+
+    # constructor
+    def __init__(self):
+        threading.Thread.__init__(self, name="PandaLogFileWriter")
+        self.daemon = True
+        self.queue = queue.SimpleQueue()
+
+    # main
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.batchSize:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            handlers = set()
+            to_stop = False
+            for item in items:
+                if item is None:
+                    to_stop = True
+                    continue
+                handler, record = item
+                try:
+                    handler.handle(record)
+                except Exception:
+                    handler.handleError(record)
+                handlers.add(handler)
+            for handler in handlers:
+                try:
+                    handler.flushBuffer()
+                except Exception:
+                    pass
+            if to_stop:
+                return
+
+    def stop(self, timeout=5):
+        self.queue.put(None)
+        self.join(timeout)
+
+
+_asyncWriter = None
+_asyncWriterPid = None
+_asyncWriterLock = threading.Lock()
+
+
+# get the async writer running in this process
+def _getAsyncWriter():
+    global _asyncWriter, _asyncWriterPid
+    pid = os.getpid()
+    if _asyncWriterPid != pid:
+        with _asyncWriterLock:
+            if _asyncWriterPid != pid:
+                _asyncWriter = _AsyncFileWriter()
+                _asyncWriter.start()
+                _asyncWriterPid = pid
+    return _asyncWriter
+
+
+# write out queued records at exit; registered after logging so that it runs before logging.shutdown
+@atexit.register
+def _stopAsyncWriter():
+    if _asyncWriterPid == os.getpid() and _asyncWriter.is_alive():
+        _asyncWriter.stop()
+
+
+# handler to pass records to the async writer with a file handler as the target
+class _AsyncQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, target):
+        logging.handlers.QueueHandler.__init__(self, None)
+        self.target = target
+
+    def prepare(self, record):
+        # merge the message and the traceback in the caller's thread since args may be changed later,
+        # while formatting and I/O are done by the target in the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = (self.target.formatter or logging._defaultFormatter).formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        _getAsyncWriter().queue.put((self.target, record))
+
+
+# file logging mode; sync or async
+fileLoggingMode = logger_config.daemon.get("file_logging_mode", "sync")
+
+
+# make rate limiting filter if the logger is configured to be limited
+def _makeRateLimitFilter(log_name):
+    target_names = [name.strip() for name in logger_config.daemon.get("rate_limit_loggers", "").split(",") if name.strip()]
+    if log_name not in target_names and "*" not in target_names:
+        return None
+    max_level = logger_config.daemon.get("rate_limit_max_level", "WARNING")
+    if max_level not in ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]:
+        max_level = "WARNING"
+    return RateLimitFilter(
+        rate=float(logger_config.daemon.get("rate_limit_rate", 0)),
+        burst=float(logger_config.daemon.get("rate_limit_burst", 0)),
+        first_n=int(logger_config.daemon.get("rate_limit_first_n", 0)),
+        every_m=int(logger_config.daemon.get("rate_limit_every_m", 0)),
+        summary_interval=int(logger_config.daemon.get("rate_limit_summary_interval", 60)),
+        max_level=getattr(logging, max_level),
+    )
+
+
 # log level
 logLevel = logging.DEBUG
 if "log_level" in logger_config.daemon:
@@ -207,7 +768,11 @@ _pandalog.setLevel(logLevel)
 _txtlog = getLoggerWrapper("panda.log")
 _weblog = getLoggerWrapper("panda.mon")
 _newweblog = getLoggerWrapper("panda.mon_new")
-_formatter = logging.Formatter("%(asctime)s %(name)-12s: %(levelname)-8s %(message)s")
+if logFormat == JSON:
+    # newline-delimited JSON
+    _formatter = _JsonFormatter()
+else:
+    _formatter = logging.Formatter("%(asctime)s %(name)-12s: %(levelname)-8s %(message)s")
 
 if len(_weblog.handlers) < 2:
     _allwebh = _PandaHTTPLogHandler(
@@ -269,7 +834,29 @@ class PandaLogger:
     def getLogger(self, log_name, log_level=None):
         log_h, new_log_flag = getLoggerWrapper("panda.log.%s" % log_name, True)
         log_h.propagate = False
+        is_async = fileLoggingMode == "async"
+        if log_level in ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"]:
+            log_level = getattr(logging, log_level)
+            if new_log_flag:
+                log_h.setLevel(log_level)
+        else:
+            log_level = logging.DEBUG
+        if new_log_flag:
+            rate_limit_filter = _makeRateLimitFilter(log_name)
+            if rate_limit_filter is not None:
+                log_h.addFilter(rate_limit_filter)
         tmp_attr = "rotating_policy"
+        # reuse the handler if already made for the same file and policy
+        handler_key = (logger_config.daemon["logdir"], log_name, logger_config.daemon.get(tmp_attr, "none"), fileLoggingMode)
+        with handlerMapLock:
+            txt_handler = handlerMap.get(handler_key)
+            if txt_handler is not None:
+                if log_level < txt_handler.level:
+                    txt_handler.setLevel(log_level)
+                    if is_async:
+                        txt_handler.target.setLevel(log_level)
+                log_h.addHandler(txt_handler)
+                return log_h
 
         if tmp_attr in logger_config.daemon and logger_config.daemon[tmp_attr] == "time":
             # interval
@@ -285,7 +872,8 @@ class PandaLogger:
             else:
                 backup_count = 1
             # handler with timed rotating
-            txt_handler = logging.handlers.TimedRotatingFileHandler(
+            handler_class = _AsyncTimedRotatingFileHandler if is_async else logging.handlers.TimedRotatingFileHandler
+            txt_handler = handler_class(
                 "%s/panda-%s.log" % (logger_config.daemon["logdir"], log_name), when="h", interval=rotating_interval, backupCount=backup_count, utc=True
             )
             if new_log_flag and rotateLog:
@@ -306,22 +894,27 @@ class PandaLogger:
             else:
                 backup_count = 1
             # handler with rotating based on size
-            txt_handler = logging.handlers.RotatingFileHandler(
-                "%s/panda-%s.log" % (logger_config.daemon["logdir"], log_name), maxBytes=max_size, backupCount=backup_count
-            )
+            handler_class = _AsyncRotatingFileHandler if is_async else logging.handlers.RotatingFileHandler
+            txt_handler = handler_class("%s/panda-%s.log" % (logger_config.daemon["logdir"], log_name), maxBytes=max_size, backupCount=backup_count)
             if new_log_flag and rotateLog:
                 txt_handler.doRollover()
         else:
-            txt_handler = logging.FileHandler("%s/panda-%s.log" % (logger_config.daemon["logdir"], log_name), encoding="utf-8")
-        if log_level in ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"]:
-            log_level = getattr(logging, log_level)
-            if new_log_flag:
-                log_h.setLevel(log_level)
-        else:
-            log_level = logging.DEBUG
+            handler_class = _AsyncFileHandler if is_async else logging.FileHandler
+            txt_handler = handler_class("%s/panda-%s.log" % (logger_config.daemon["logdir"], log_name), encoding="utf-8")
         txt_handler.setLevel(log_level)
         txt_handler.setFormatter(_formatter)
-        log_h.addHandler(txt_handler)
+        if is_async:
+            # format and write in the writer thread
+            txt_handler = _AsyncQueueHandler(txt_handler)
+            txt_handler.setLevel(log_level)
+        with handlerMapLock:
+            if handler_key in handlerMap:
+                # made by another thread in the meantime
+                txt_handler.close()
+                txt_handler = handlerMap[handler_key]
+            else:
+                handlerMap[handler_key] = txt_handler
+            log_h.addHandler(txt_handler)
         return log_h
 
     def getHttpLogger(self, log_name):
@@ -350,6 +943,17 @@ class PandaLogger:
         if "loghost_new" in logger_config.daemon:
             _newwebh.releaseHandler()
 
+    # get numbers of loggers, file handlers, and file descriptors in the process
+    @staticmethod
+    def getHandlerStats():
+        with handlerMapLock:
+            n_handlers = len(handlerMap)
+        try:
+            n_fds = len(os.listdir("/proc/self/fd"))
+        except Exception:
+            n_fds = None
+        return {"loggers": len(loggerMap), "file_handlers": n_handlers, "fds": n_fds}
+
     # rollover
     @staticmethod
     def doRollOver():
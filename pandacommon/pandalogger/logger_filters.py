@@ -0,0 +1,146 @@
+import atexit
+import logging
+import os
+import threading
+import time
+
+
+# filter to limit records per logger and message template
+class RateLimitFilter(logging.Filter):
+    """
+    Rate limiting filter for high-volume loggers.
+    Records are grouped by (logger name, level, message template), where the template is the message
+    before %-style arguments are merged, or panda_template given by LogWrapper.
+    In each summary interval, a group passes the first first_n records and then every every_m-th record,
+    and is also limited by a token bucket of rate records per second with burst capacity.
+    Counts of suppressed records are reported at WARNING, or at the level of the group if higher, once per summary interval
+    by a background thread, and at exit of the process.
+    Records above max_level are never limited.
+    """
+
+    # max number of groups to keep track of
+    max_groups = 10000
+
+    def __init__(self, name="", rate=0, burst=None, first_n=0, every_m=0, summary_interval=60, max_level=logging.WARNING):
+        logging.Filter.__init__(self, name)
+        # records per second; 0 for no token bucket
+        self.rate = rate
+        # capacity of token bucket
+        self.burst = burst if burst else max(rate, 1)
+        # number of records to pass before sampling; 0 for no sampling
+        self.first_n = first_n
+        # pass every m-th record after first_n; 0 to suppress all after first_n, or not to sample if first_n is 0 too
+        self.every_m = every_m
+        # period in seconds to report suppressed records and reset counts
+        self.summary_interval = summary_interval
+        # max level to be limited
+        self.max_level = max_level
+        # state of groups {key: [tokens, last_refill_time, count, n_suppressed]}
+        self.states = {}
+        self.lock = threading.Lock()
+        self.last_summary_time = time.monotonic()
+        # total number of suppressed records
+        self.n_suppressed = 0
+        # process ID where the thread to report summaries is running
+        self.timer_pid = None
+        # whether flush is registered to run at exit, which is inherited by forked processes
+        self.is_atexit_registered = False
+
+    def _is_allowed(self, state, time_now):
+        state[2] += 1
+        if (self.first_n or self.every_m) and state[2] > self.first_n:
+            if self.every_m <= 0 or (state[2] - self.first_n - 1) % self.every_m != 0:
+                return False
+        if self.rate:
+            state[0] = min(self.burst, state[0] + (time_now - state[1]) * self.rate)
+            state[1] = time_now
+            if state[0] < 1:
+                return False
+            state[0] -= 1
+        return True
+
+    def _take_summaries(self, time_now):
+        """
+        take suppressed counts and reset groups, with the lock held
+        return list of (logger name, level, template, n_suppressed, seconds since the last summary)
+        """
+        summaries = []
+        period = time_now - self.last_summary_time
+        for (logger_name, levelno, template), state in self.states.items():
+            if state[3]:
+                summaries.append((logger_name, levelno, template, state[3], period))
+        self.states = {}
+        self.last_summary_time = time_now
+        return summaries
+
+    def _report(self, summaries):
+        for logger_name, levelno, template, n_suppressed, period in summaries:
+            logging.getLogger(logger_name).log(
+                max(logging.WARNING, levelno),
+                "suppressed %d similar messages in %d sec: %.200s",
+                n_suppressed,
+                period,
+                template,
+                extra={"panda_rate_limit_summary": True},
+            )
+
+    def _start_timer(self):
+        """
+        start a daemon thread in this process to report summaries of groups which got quiet, and report them at exit
+        """
+        thread = threading.Thread(target=self._run_timer, args=(self.timer_pid,), name="RateLimitFilter-summary", daemon=True)
+        thread.start()
+        with self.lock:
+            if self.is_atexit_registered:
+                return
+            self.is_atexit_registered = True
+        atexit.register(self.flush)
+
+    def _run_timer(self, pid):
+        while self.timer_pid == pid:
+            with self.lock:
+                wait_time = self.last_summary_time + self.summary_interval - time.monotonic()
+            time.sleep(max(wait_time, 1))
+            self.flush(force=False)
+
+    def flush(self, force=True):
+        """
+        report suppressed records and reset groups
+        force: False to do nothing until the summary interval passes
+        """
+        time_now = time.monotonic()
+        with self.lock:
+            if not force and time_now - self.last_summary_time < self.summary_interval:
+                return
+            summaries = self._take_summaries(time_now)
+        self._report(summaries)
+
+    def filter(self, record):
+        if record.levelno > self.max_level or getattr(record, "panda_rate_limit_summary", False):
+            return True
+        template = getattr(record, "panda_template", record.msg)
+        key = (record.name, record.levelno, str(template))
+        time_now = time.monotonic()
+        summaries = None
+        with self.lock:
+            if time_now - self.last_summary_time >= self.summary_interval:
+                summaries = self._take_summaries(time_now)
+            state = self.states.get(key)
+            if state is None:
+                if len(self.states) >= self.max_groups:
+                    summaries = (summaries or []) + self._take_summaries(time_now)
+                state = [self.burst, time_now, 0, 0]
+                self.states[key] = state
+            is_allowed = self._is_allowed(state, time_now)
+            to_start_timer = False
+            if not is_allowed:
+                state[3] += 1
+                self.n_suppressed += 1
+                if self.timer_pid != os.getpid():
+                    self.timer_pid = os.getpid()
+                    to_start_timer = True
+        if summaries:
+            self._report(summaries)
+        if to_start_timer:
+            self._start_timer()
+        return is_allowed
@@ -8,6 +8,26 @@ from .PandaLogger import PandaLogger
 # global memory profiling option
 with_memory_profile = False
 
+# cache of (module name, function name) per code object of callers
+_caller_info_cache = {}
+
+
+# get module name and function name of the caller at the depth, without materializing the whole stack
+def get_caller_info(depth=1):
+    try:
+        frame = sys._getframe(depth + 1)
+    except AttributeError:
+        # no frame access in this interpreter
+        frame_info = inspect.stack()[depth + 1]
+        mod = inspect.getmodule(frame_info[0])
+        return mod.__name__.split(".")[-1] if mod else "", frame_info[3]
+    code = frame.f_code
+    info = _caller_info_cache.get(code)
+    if info is None:
+        info = (frame.f_globals.get("__name__", "").split(".")[-1], code.co_name)
+        _caller_info_cache[code] = info
+    return info
+
 
 # enable memory profiling
 def enable_memory_profiling():
@@ -18,9 +38,7 @@ def enable_memory_profiling():
 # setup logger
 def setup_logger(name=None, log_level=None):
     if name is None:
-        frm = inspect.stack()[1][0]
-        mod = inspect.getmodule(frm)
-        name = mod.__name__.split(".")[-1]
+        name = get_caller_info()[0]
 
     if log_level:
         return PandaLogger().getLogger(name, log_level=log_level)
@@ -32,7 +50,7 @@ def setup_logger(name=None, log_level=None):
 def make_logger(tmp_log, token=None, method_name=None, hook=None):
     # get method name of caller
     if method_name is None:
-        tmp_str = inspect.stack()[1][3]
+        tmp_str = get_caller_info()[1]
     else:
         tmp_str = method_name
 
@@ -48,7 +66,7 @@ def make_logger(tmp_log, token=None, method_name=None, hook=None):
 # dump error message
 def dump_error_message(tmp_log, err_str=None, no_message=False):
     if not isinstance(tmp_log, LogWrapper):
-        method_name = "{0} : ".format(inspect.stack()[1][3])
+        method_name = "{0} : ".format(get_caller_info()[1])
     else:
         method_name = ""
     # error
@@ -0,0 +1,663 @@
+import asyncio
+import random
+import re
+import ssl
+import time
+import traceback
+import uuid
+
+from pandacommon.pandalogger import logger_utils
+
+from .msg_bkr_utils import _resolve_host_port_list, get_fqdn_pid
+
+# logger
+base_logger = logger_utils.setup_logger("async_msg_bkr_utils")
+
+# max size of a frame line or body without content-length
+_STREAM_LIMIT = 2**24
+
+# escaping of header in STOMP 1.2
+_ESCAPE_MAP = {"\\": "\\\\", "\r": "\\r", "\n": "\\n", ":": "\\c"}
+_UNESCAPE_MAP = {"\\": "\\", "r": "\r", "n": "\n", "c": ":"}
+_UNESCAPE_RE = re.compile(r"\\(.)")
+
+
+def _escape_header(value):
+    return "".join(_ESCAPE_MAP.get(c, c) for c in str(value))
+
+
+def _unescape_header(value):
+    return _UNESCAPE_RE.sub(lambda m: _UNESCAPE_MAP.get(m.group(1), m.group(0)), value)
+
+
+# pack a frame
+def _pack_frame(cmd, headers=None, body=b""):
+    """
+    get bytes of STOMP frame
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    # no escaping in CONNECT frame
+    to_escape = cmd != "CONNECT"
+    lines = [cmd]
+    if headers:
+        for key, val in headers.items():
+            if val is None:
+                continue
+            if to_escape:
+                lines.append("{0}:{1}".format(_escape_header(key), _escape_header(val)))
+            else:
+                lines.append("{0}:{1}".format(key, val))
+    if body and not (headers and "content-length" in headers):
+        lines.append("content-length:{0}".format(len(body)))
+    return ("\n".join(lines) + "\n\n").encode("utf-8") + body + b"\x00"
+
+
+# read a frame
+async def _read_frame(reader):
+    """
+    read a STOMP frame from stream
+    return (cmd, headers, body), or None for heart-beat
+    """
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("connection closed by peer")
+    line = line.rstrip(b"\r\n")
+    if not line:
+        # heart-beat
+        return None
+    cmd = line.decode("utf-8")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("connection closed by peer")
+        line = line.rstrip(b"\r\n").decode("utf-8")
+        if not line:
+            break
+        key, _, val = line.partition(":")
+        if cmd != "CONNECTED":
+            key = _unescape_header(key)
+            val = _unescape_header(val)
+        # the first header is used if repeated
+        headers.setdefault(key, val)
+    if "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]) + 1)
+    else:
+        body = await reader.readuntil(b"\x00")
+    return cmd, headers, body[:-1].decode("utf-8", "replace")
+
+
+# STOMP connection on asyncio
+class AsyncStompConnection:
+    """
+    STOMP 1.2 connection to a single broker, running on the event loop instead of receiver/heartbeat threads
+    """
+
+    def __init__(self, conn_id, host, port, ssl_context=None, vhost=None, send_heartbeat_ms=60000, recv_heartbeat_ms=0, on_frame=None, on_disconnected=None):
+        # logger
+        self.logger = logger_utils.make_logger(base_logger, token=conn_id, method_name="AsyncStompConnection")
+        # connection ID
+        self.conn_id = conn_id
+        # connection parameters
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.vhost = vhost
+        # heartbeat periods in milliseconds
+        self.send_heartbeat_ms = send_heartbeat_ms
+        self.recv_heartbeat_ms = recv_heartbeat_ms
+        # coroutine function called with (conn_id, cmd, headers, body) for each frame
+        self.on_frame = on_frame
+        # function called with conn_id when disconnected unexpectedly
+        self.on_disconnected = on_disconnected
+        # stream
+        self.reader = None
+        self.writer = None
+        self.drain_lock = None
+        # tasks
+        self.reader_task = None
+        self.heartbeat_task = None
+        # status
+        self.connected = False
+        self.closing = False
+        self.last_write_time = time.monotonic()
+        # max seconds to wait for a frame or heartbeat from the broker; None not to check
+        self.read_timeout = None
+
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self, username=None, passcode=None, headers=None, timeout=30, **kwargs):
+        """
+        open the connection and send CONNECT
+        return headers of CONNECTED frame
+        """
+        self.closing = False
+        self.drain_lock = asyncio.Lock()
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self.ssl_context, limit=_STREAM_LIMIT), timeout)
+        connect_headers = {
+            "accept-version": "1.2",
+            "host": self.vhost if self.vhost else self.host,
+            "heart-beat": "{0},{1}".format(self.send_heartbeat_ms, self.recv_heartbeat_ms),
+            "login": username,
+            "passcode": passcode,
+        }
+        if headers:
+            connect_headers.update(headers)
+        self.writer.write(_pack_frame("CONNECT", connect_headers))
+        await self.writer.drain()
+        # wait for CONNECTED
+        frame = None
+        while frame is None:
+            frame = await asyncio.wait_for(_read_frame(self.reader), timeout)
+        cmd, server_headers, body = frame
+        if cmd != "CONNECTED":
+            self.writer.close()
+            raise ConnectionError("failed to connect to {0} ; {1} {2} | {3}".format(self.conn_id, cmd, server_headers, body))
+        self.connected = True
+        self.last_write_time = time.monotonic()
+        # negotiate heartbeat
+        try:
+            server_send_ms, server_recv_ms = [int(x) for x in server_headers.get("heart-beat", "0,0").split(",")]
+        except ValueError:
+            server_send_ms, server_recv_ms = 0, 0
+        heartbeat_ms = 0
+        if self.send_heartbeat_ms and server_recv_ms:
+            heartbeat_ms = max(self.send_heartbeat_ms, server_recv_ms)
+        # the broker is regarded as dead without any frame or heartbeat in twice its heartbeat period
+        self.read_timeout = None
+        if self.recv_heartbeat_ms and server_send_ms:
+            self.read_timeout = 2 * max(self.recv_heartbeat_ms, server_send_ms) / 1000
+        # start tasks
+        self.reader_task = asyncio.ensure_future(self._read_loop())
+        if heartbeat_ms:
+            self.heartbeat_task = asyncio.ensure_future(self._heartbeat_loop(heartbeat_ms / 1000))
+        return server_headers
+
+    async def _read_loop(self):
+        try:
+            while True:
+                try:
+                    frame = await asyncio.wait_for(_read_frame(self.reader), self.read_timeout)
+                except asyncio.TimeoutError:
+                    self.logger.warning("no heartbeat from {0} in {1} sec ; regarded as disconnected".format(self.conn_id, self.read_timeout))
+                    break
+                if frame is None:
+                    continue
+                if self.on_frame is not None:
+                    try:
+                        await self.on_frame(self.conn_id, *frame)
+                    except Exception as e:
+                        self.logger.error(
+                            "failed to handle {0} frame from {1} ; {2}: {3} \n{4}".format(
+                                frame[0], self.conn_id, e.__class__.__name__, e, traceback.format_exc()
+                            )
+                        )
+                        break
+        except asyncio.CancelledError:
+            raise
+        except (ConnectionError, OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            self.connected = False
+            if self.heartbeat_task is not None:
+                self.heartbeat_task.cancel()
+            if not self.closing and self.writer is not None:
+                # stop delivery to this connection so that the proxy reconnects
+                self.writer.close()
+            if not self.closing and self.on_disconnected is not None:
+                self.on_disconnected(self.conn_id)
+
+    async def _heartbeat_loop(self, interval):
+        while self.connected:
+            await asyncio.sleep(interval - (time.monotonic() - self.last_write_time))
+            if time.monotonic() - self.last_write_time >= interval:
+                try:
+                    await self._write(b"\n")
+                except Exception:
+                    return
+
+    async def _write(self, data):
+        self.writer.write(data)
+        self.last_write_time = time.monotonic()
+        async with self.drain_lock:
+            await self.writer.drain()
+
+    async def send_frame(self, cmd, headers=None, body=b""):
+        """
+        send a frame
+        """
+        if not self.connected:
+            raise ConnectionError("not connected to {0}".format(self.conn_id))
+        await self._write(_pack_frame(cmd, headers, body))
+
+    async def subscribe(self, destination, id, ack="auto", headers=None):
+        frame_headers = {"destination": destination, "id": id, "ack": ack}
+        if headers:
+            frame_headers.update(headers)
+        await self.send_frame("SUBSCRIBE", frame_headers)
+
+    async def unsubscribe(self, id):
+        await self.send_frame("UNSUBSCRIBE", {"id": id})
+
+    async def send(self, destination, body, headers=None):
+        frame_headers = {"destination": destination}
+        if headers:
+            frame_headers.update(headers)
+        await self.send_frame("SEND", frame_headers, body)
+
+    async def ack(self, id, transaction=None):
+        await self.send_frame("ACK", {"id": id, "transaction": transaction})
+
+    async def nack(self, id, transaction=None):
+        await self.send_frame("NACK", {"id": id, "transaction": transaction})
+
+    async def begin(self):
+        txs_id = str(uuid.uuid4())
+        await self.send_frame("BEGIN", {"transaction": txs_id})
+        return txs_id
+
+    async def commit(self, txs_id):
+        await self.send_frame("COMMIT", {"transaction": txs_id})
+
+    async def abort(self, txs_id):
+        await self.send_frame("ABORT", {"transaction": txs_id})
+
+    async def disconnect(self):
+        """
+        send DISCONNECT and close the connection
+        """
+        self.closing = True
+        if self.connected:
+            try:
+                await self.send_frame("DISCONNECT")
+            except Exception:
+                pass
+        self.connected = False
+        for task in (self.heartbeat_task, self.reader_task):
+            if task is not None:
+                task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+
+
+# message object on asyncio
+class AsyncMsgObj(object):
+    """
+    Message object consumed from AsyncMBListenerProxy
+    Support async with-statement, or awaitable ack() and nack()
+    """
+
+    __slots__ = ("__mb_proxy", "conn_id", "sub_id", "msg_id", "ack_id", "data", "is_transacted", "txs_id")
+
+    def __init__(self, mb_proxy, conn_id, msg_id, ack_id, data, is_transacted=True):
+        # associated proxy object
+        self.__mb_proxy = mb_proxy
+        # connection ID
+        self.conn_id = conn_id
+        # subscription ID
+        self.sub_id = self.__mb_proxy.sub_id
+        # message ID
+        self.msg_id = msg_id
+        # acknowledgement ID
+        self.ack_id = ack_id
+        # real message data
+        self.data = data
+        # whether use transaction
+        self.is_transacted = is_transacted
+        # transaction ID
+        self.txs_id = None
+
+    async def ack(self):
+        await self.__mb_proxy._ack(self.conn_id, self.msg_id, self.ack_id)
+
+    async def nack(self):
+        await self.__mb_proxy._nack(self.conn_id, self.msg_id, self.ack_id)
+
+    async def __aenter__(self):
+        if self.is_transacted:
+            # transaction ID
+            self.txs_id = await self.__mb_proxy._begin(self.conn_id)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.is_transacted:
+            if exc_type or exc_value:
+                # exception occurs, send abort
+                await self.__mb_proxy._abort(self.conn_id, self.txs_id)
+            else:
+                # done, send ack and commit
+                await self.__mb_proxy._ack(self.conn_id, self.msg_id, self.ack_id)
+                await self.__mb_proxy._commit(self.conn_id, self.txs_id)
+        else:
+            if exc_type or exc_value:
+                # exception occurs, send nack
+                await self.__mb_proxy._nack(self.conn_id, self.msg_id, self.ack_id)
+            else:
+                # done, send ack
+                await self.__mb_proxy._ack(self.conn_id, self.msg_id, self.ack_id)
+
+
+# asyncio message broker proxy base
+class AsyncMBProxyBase:
+    """
+    Base AsyncMBProxy class
+    All connections of all proxies run on the same event loop
+    """
+
+    def __init__(
+        self,
+        name,
+        host_port_list,
+        destination,
+        use_ssl=False,
+        cert_file=None,
+        key_file=None,
+        vhost=None,
+        username=None,
+        passcode=None,
+        verbose=False,
+        send_heartbeat_ms=60000,
+        recv_heartbeat_ms=0,
+        **kwargs,
+    ):
+        # logger
+        self.logger = logger_utils.make_logger(base_logger, token=name, method_name=self.__class__.__name__)
+        # name of message queue
+        self.name = name
+        # connection parameters
+        self.host_port_list = host_port_list
+        self.use_ssl = use_ssl
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.vhost = vhost
+        # original destination
+        self.orig_destination = destination
+        # destination to subscribe or send
+        self.destination = self.orig_destination
+        # randomness
+        fqdn_pid = get_fqdn_pid()
+        n_rand = random.randrange(10**6)
+        # subscription ID
+        self.sub_id = "panda-{0}_{1}_r{2:06}".format(self.__class__.__name__, fqdn_pid, n_rand)
+        # client ID
+        self.client_id = "client_{0}_{1}".format(self.sub_id, hex(id(self)))
+        # connect parameters
+        self.connect_params = {"username": username, "passcode": passcode, "headers": {"client-id": self.client_id}}
+        # connection dict
+        self.connection_dict = {}
+        # number of attempts to restart
+        self.n_restart = 0
+        # whether got disconnected unexpectedly
+        self.got_disconnected = False
+        # whether to disconnect intentionally
+        self.to_disconnect = False
+        # whether to log verbosely
+        self.verbose = verbose
+        # sending and wanting-to-receive heartbeat period in milliseconds
+        self.send_heartbeat_ms = send_heartbeat_ms
+        self.recv_heartbeat_ms = recv_heartbeat_ms
+
+    def _get_ssl_context(self):
+        if not self.use_ssl:
+            return None
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+        if self.cert_file:
+            ssl_context.load_cert_chain(self.cert_file, self.key_file)
+        return ssl_context
+
+    async def _get_connection_dict(self):
+        """
+        get dict {conn_id: connection} to all distinct hosts behind hostnames
+        """
+        loop = asyncio.get_running_loop()
+        resolved_host_port_set = await loop.run_in_executor(None, _resolve_host_port_list, self.host_port_list)
+        ssl_context = self._get_ssl_context()
+        conn_dict = {}
+        for host, port in resolved_host_port_set:
+            conn_id = "{0}:{1}".format(host, port)
+            conn_dict[conn_id] = AsyncStompConnection(
+                conn_id,
+                host,
+                port,
+                ssl_context=ssl_context,
+                vhost=self.vhost,
+                send_heartbeat_ms=self.send_heartbeat_ms,
+                recv_heartbeat_ms=self.recv_heartbeat_ms,
+                on_frame=self._on_frame,
+                on_disconnected=self._on_disconnected,
+            )
+        self.logger.debug("got {0} connections to {1}".format(len(conn_dict), " , ".join(conn_dict.keys())))
+        return conn_dict
+
+    def _on_connected(self, headers):
+        # destination change for rabbitmq queue /queue vs /amq/queue
+        mq_server = headers.get("server")
+        if mq_server and mq_server.startswith("RabbitMQ/") and self.orig_destination.startswith("/queue/"):
+            self.destination = re.sub(r"^/queue/", "/amq/queue/", self.orig_destination)
+            self.logger.debug(f"_on_connected : connected RabbitMQ; modified destination into {self.destination}")
+
+    def _on_disconnected(self, conn_id):
+        self.logger.debug("_on_disconnected from {c} called".format(c=conn_id))
+        self.got_disconnected = True
+
+    async def _on_frame(self, conn_id, cmd, headers, body):
+        if cmd == "MESSAGE":
+            await self._on_message(headers, body, conn_id)
+        elif cmd == "ERROR":
+            self.logger.error("on_error from {c}: {h} | {b}".format(c=conn_id, h=headers, b=body))
+        elif self.verbose:
+            self.logger.debug("got {0} from {1}: {2}".format(cmd, conn_id, headers))
+
+    async def _on_message(self, headers, body, conn_id):
+        if self.verbose:
+            self.logger.debug("_on_message from {c} drop message: {h} | {b}".format(c=conn_id, h=headers, b=body))
+
+    async def _start_connection(self, conn_id, conn):
+        """
+        connect; to be extended to subscribe
+        """
+        headers = await conn.connect(**self.connect_params)
+        self._on_connected(headers)
+
+    async def go(self):
+        """
+        connect to all brokers concurrently
+        """
+        self.logger.debug("go called")
+        self.to_disconnect = False
+        if not self.connection_dict:
+            self.connection_dict = await self._get_connection_dict()
+        conn_items = [(conn_id, conn) for conn_id, conn in self.connection_dict.items() if not conn.is_connected()]
+        results = await asyncio.gather(*[self._start_connection(conn_id, conn) for conn_id, conn in conn_items], return_exceptions=True)
+        for (conn_id, conn), result in zip(conn_items, results):
+            if isinstance(result, Exception):
+                tb_str = "".join(traceback.format_exception(type(result), result, result.__traceback__))
+                self.logger.error("failed to start connection to {0} {1} ; {2} \n{3}".format(conn_id, self.destination, result.__class__.__name__, tb_str))
+                self.got_disconnected = True
+            else:
+                self.logger.info("connected to {0} for {1}".format(conn_id, self.destination))
+
+    async def stop(self):
+        self.logger.debug("stop called")
+        self.to_disconnect = True
+        await asyncio.gather(*[conn.disconnect() for conn in self.connection_dict.values()], return_exceptions=True)
+        self.logger.info("disconnected from {0}".format(self.destination))
+
+    async def restart(self):
+        self.logger.debug("restart called")
+        self.n_restart += 1
+        self.logger.debug("the {0}th attempt to restart...".format(self.n_restart))
+        await self.stop()
+        self.got_disconnected = False
+        self.connection_dict = await self._get_connection_dict()
+        await self.go()
+        self.logger.info("the {0}th restart ended".format(self.n_restart))
+
+
+# asyncio message broker proxy for receiver
+class AsyncMBListenerProxy(AsyncMBProxyBase):
+    """
+    Listener proxy on asyncio
+    Messages can be taken with get_messages() or "async for msg_obj in proxy"
+    """
+
+    def __init__(self, name, host_port_list, destination, ack_mode="client-individual", prefetch_size=None, max_buffer_len=999, use_transaction=True, **kwargs):
+        AsyncMBProxyBase.__init__(self, name, host_port_list, destination, **kwargs)
+        # acknowledge mode
+        self.ack_mode = ack_mode
+        # prefetch count of the MB (max number of un-acknowledge messages allowed)
+        self.prefetch_size = prefetch_size
+        # max length of local buffer; reading from sockets pauses when full
+        self.max_buffer_len = max_buffer_len
+        # whether to enable transaction of message broker to wrap the message processing
+        self.use_transaction = use_transaction
+        # local buffer, created on the event loop
+        self.msg_queue = None
+        # event set when stopped, to end iteration
+        self.stop_event = None
+        # subscription headers
+        self.subscription_headers = {}
+        if self.prefetch_size is not None:
+            self.subscription_headers.update(
+                {
+                    "activemq.prefetchSize": self.prefetch_size,  # for ActiveMQ
+                    "prefetch-count": self.prefetch_size,  # for RabbitMQ
+                }
+            )
+
+    def _init_queue(self):
+        if self.msg_queue is None:
+            self.msg_queue = asyncio.Queue(maxsize=self.max_buffer_len or 0)
+            self.stop_event = asyncio.Event()
+
+    async def _begin(self, conn_id):
+        txs_id = await self.connection_dict[conn_id].begin()
+        if self.verbose:
+            self.logger.debug("{conid} txid={txid} BEGIN".format(conid=conn_id, txid=txs_id))
+        return txs_id
+
+    async def _commit(self, conn_id, txs_id):
+        await self.connection_dict[conn_id].commit(txs_id)
+        if self.verbose:
+            self.logger.debug("{conid} txid={txid} COMMIT".format(conid=conn_id, txid=txs_id))
+
+    async def _abort(self, conn_id, txs_id):
+        await self.connection_dict[conn_id].abort(txs_id)
+        self.logger.warning("{conid} txid={txid} ABORT".format(conid=conn_id, txid=txs_id))
+
+    async def _ack(self, conn_id, msg_id, ack_id, txs_id=None):
+        if self.ack_mode in ["client", "client-individual"]:
+            await self.connection_dict[conn_id].ack(ack_id, transaction=txs_id)
+            if self.verbose:
+                self.logger.debug("{conid} {mid} {ackid} ACK".format(conid=conn_id, mid=msg_id, ackid=ack_id))
+
+    async def _nack(self, conn_id, msg_id, ack_id, txs_id=None):
+        if self.ack_mode in ["client", "client-individual"]:
+            await self.connection_dict[conn_id].nack(ack_id, transaction=txs_id)
+            self.logger.warning("{conid} {mid} {ackid} NACK".format(conid=conn_id, mid=msg_id, ackid=ack_id))
+
+    async def _on_message(self, headers, body, conn_id):
+        msg_obj = AsyncMsgObj(
+            mb_proxy=self, conn_id=conn_id, msg_id=headers["message-id"], ack_id=headers.get("ack"), data=body, is_transacted=self.use_transaction
+        )
+        # wait for a free slot; the socket is not read meanwhile
+        await self.msg_queue.put(msg_obj)
+        if self.verbose:
+            self.logger.debug("_on_message put into buffer ({nbm}): {h}".format(nbm=self.msg_queue.qsize(), h=headers))
+
+    async def _start_connection(self, conn_id, conn):
+        await AsyncMBProxyBase._start_connection(self, conn_id, conn)
+        await conn.subscribe(destination=self.destination, id=self.sub_id, ack=self.ack_mode, headers=self.subscription_headers)
+
+    async def go(self):
+        self._init_queue()
+        self.stop_event.clear()
+        await AsyncMBProxyBase.go(self)
+
+    async def stop(self):
+        await AsyncMBProxyBase.stop(self)
+        if self.stop_event is not None:
+            self.stop_event.set()
+
+    async def get_messages(self, limit=100, timeout=0):
+        """
+        get some messages capped by limit from local buffer
+        timeout: seconds to wait for the first message to arrive; 0 not to wait
+        return list of message objects
+        """
+        self._init_queue()
+        msg_list = []
+        if timeout and self.msg_queue.empty():
+            try:
+                msg_list.append(await asyncio.wait_for(self.msg_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                return msg_list
+        while len(msg_list) < limit and not self.msg_queue.empty():
+            msg_list.append(self.msg_queue.get_nowait())
+        if self.verbose:
+            self.logger.debug("got {n} messages".format(n=len(msg_list)))
+        return msg_list
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """
+        wait for the next message; iteration ends when the proxy is stopped
+        """
+        self._init_queue()
+        if not self.msg_queue.empty():
+            return self.msg_queue.get_nowait()
+        if self.stop_event.is_set():
+            raise StopAsyncIteration
+        get_task = asyncio.ensure_future(self.msg_queue.get())
+        stop_task = asyncio.ensure_future(self.stop_event.wait())
+        done, pending = await asyncio.wait([get_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        if get_task in done:
+            return get_task.result()
+        raise StopAsyncIteration
+
+
+# asyncio message broker proxy for sender
+class AsyncMBSenderProxy(AsyncMBProxyBase):
+    """
+    Sender proxy on asyncio, sending messages through one of the brokers behind hostnames
+    """
+
+    async def _get_connection_dict(self):
+        conn_dict = await AsyncMBProxyBase._get_connection_dict(self)
+        conn_id = random.choice(list(conn_dict))
+        return {conn_id: conn_dict[conn_id]}
+
+    async def send(self, data, headers=None, **kwargs):
+        """
+        send a message to queue
+        """
+        if data is None:
+            self.logger.debug("got None, not to send")
+            return
+        headers_dict = {}
+        if headers is not None:
+            headers_dict.update(headers)
+        headers_dict.update(kwargs)
+        try:
+            conn = next(iter(self.connection_dict.values()))
+            await conn.send(destination=self.destination, body=data, headers=headers_dict)
+        except Exception as e:
+            tb_str = traceback.format_exc()
+            self.logger.error(
+                "failed to send message to {0} ; data={1} headers={2} ; {3} \n{4}".format(self.destination, data, headers_dict, e.__class__.__name__, tb_str)
+            )
+        else:
+            if self.verbose:
+                self.logger.debug("send to {dest} | {data}".format(dest=self.destination, data=data))
@@ -1,4 +1,5 @@
 import collections
+import concurrent.futures
 import copy
 import datetime
 import os
@@ -12,9 +13,9 @@ import traceback
 import uuid
 
 try:
-    from queue import Empty, Queue
+    from queue import Empty, Full, Queue
 except ImportError:
-    from Queue import Empty, Queue
+    from Queue import Empty, Full, Queue
 
 import stomp
 
@@ -36,6 +37,12 @@ for handler in panda_stomp_logger.handlers.copy():
 stomp_logger.setLevel(stomp_log_level)
 stomp_logger.propagate = False
 
+# whether SEND frames can be packed and written at once; it relies on internals of stomp.py 8
+try:
+    _CAN_COALESCE_FRAMES = isinstance(stomp.__version__, str) and stomp.__version__.split(".")[0] == "8"
+except Exception:
+    _CAN_COALESCE_FRAMES = False
+
 # global lock
 _GLOBAL_LOCK = threading.Lock()
 
@@ -43,16 +50,11 @@ _GLOBAL_LOCK = threading.Lock()
 _BUFFER_MAP = {}
 
 
-# get connection dict
-def _get_connection_dict(
-    host_port_list, use_ssl=False, cert_file=None, key_file=None, vhost=None, keepalive=True, send_heartbeat_ms=60000, recv_heartbeat_ms=0
-):
+# resolve hosts
+def _resolve_host_port_list(host_port_list):
     """
-    get dict {conn_id: connection}
+    get set of (host, port) of all distinct hosts behind hostnames in host_port_list
     """
-    tmp_logger = logger_utils.make_logger(base_logger, method_name="_get_connection_dict")
-    conn_dict = dict()
-    # resolve all distinct hosts behind hostname
     resolved_host_port_set = set()
     for host_port in host_port_list:
         host, port = host_port.split(":")
@@ -61,6 +63,20 @@ def _get_connection_dict(
         for addrinfo in addrinfos:
             resolved_host = socket.getfqdn(addrinfo[4][0])
             resolved_host_port_set.add((resolved_host, port))
+    return resolved_host_port_set
+
+
+# get connection dict
+def _get_connection_dict(
+    host_port_list, use_ssl=False, cert_file=None, key_file=None, vhost=None, keepalive=True, send_heartbeat_ms=60000, recv_heartbeat_ms=0
+):
+    """
+    get dict {conn_id: connection}
+    """
+    tmp_logger = logger_utils.make_logger(base_logger, method_name="_get_connection_dict")
+    conn_dict = dict()
+    # resolve all distinct hosts behind hostname
+    resolved_host_port_set = _resolve_host_port_list(host_port_list)
     # make connections
     for host, port in resolved_host_port_set:
         host_port = "{0}:{1}".format(host, port)
@@ -82,6 +98,15 @@ def _get_connection_dict(
     return conn_dict
 
 
+# get backoff delay
+def _get_backoff_delay(n_retry, base_sec=1, max_sec=300):
+    """
+    get exponential backoff delay in seconds for the n-th retry, with jitter to spread retries of many clients
+    """
+    delay = min(max_sec, base_sec * 2 ** max(n_retry - 1, 0))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
 # get fqdn pid
 def get_fqdn_pid():
     """
@@ -107,6 +132,20 @@ class MsgBuffer:
         self.queue_name = queue_name
         # interval fifo
         self.__fifo = collections.deque()
+        # lock and conditions to wake up consumers when messages arrive and producers when slots are freed
+        self.__lock = threading.Lock()
+        self.__not_empty = threading.Condition(self.__lock)
+        self.__not_full = threading.Condition(self.__lock)
+        # max number of objects in the buffer; None for unlimited
+        self.max_len = None
+        # watermarks to pause/resume the producer; None to disable
+        self.high_watermark = None
+        self.low_watermark = None
+        # whether the buffer has reached the high watermark and not yet drained to the low watermark
+        self.__above_high_watermark = False
+        # callbacks called when crossing the watermarks
+        self.__on_high_watermark = None
+        self.__on_low_watermark = None
 
     def __new__(cls, queue_name):
         key = queue_name
@@ -121,18 +160,108 @@ class MsgBuffer:
         # Do NOT write anything here becuase of singleton
         pass
 
+    def set_limits(self, max_len=None, high_watermark=None, low_watermark=None):
+        """
+        Set capacity and watermarks of the buffer
+        max_len: max number of objects before put blocks; None for unlimited
+        high_watermark: size at which the high watermark callback is called; None to disable watermarks
+        low_watermark: size at which the low watermark callback is called after reaching the high watermark; default is half of high_watermark
+        """
+        with self.__lock:
+            self.max_len = max_len
+            self.high_watermark = high_watermark
+            if high_watermark is not None and low_watermark is None:
+                low_watermark = high_watermark // 2
+            self.low_watermark = low_watermark
+            self.__not_full.notify_all()
+
+    def set_watermark_callbacks(self, on_high=None, on_low=None):
+        """
+        Set callbacks without arguments, called outside the buffer lock when the size reaches the high watermark and then drains to the low watermark
+        """
+        with self.__lock:
+            self.__on_high_watermark = on_high
+            self.__on_low_watermark = on_low
+
+    def is_above_high_watermark(self):
+        return self.__above_high_watermark
+
     def size(self):
         return len(self.__fifo)
 
-    def get(self):
-        try:
+    def _check_high_watermark(self):
+        """
+        Check the high watermark with the lock held by the caller
+        return callback to call after releasing the lock, or None
+        """
+        if self.high_watermark is not None and not self.__above_high_watermark and len(self.__fifo) >= self.high_watermark:
+            self.__above_high_watermark = True
+            return self.__on_high_watermark
+        return None
+
+    def _check_low_watermark(self):
+        """
+        Check the low watermark with the lock held by the caller
+        return callback to call after releasing the lock, or None
+        """
+        if self.__above_high_watermark and len(self.__fifo) <= self.low_watermark:
+            self.__above_high_watermark = False
+            return self.__on_low_watermark
+        return None
+
+    def get(self, timeout=0):
+        """
+        Get one object from the buffer
+        timeout: seconds to wait for an object to arrive; 0 not to wait, None to wait forever
+        return None if nothing arrives in time
+        """
+        with self.__lock:
+            if not self.__not_empty.wait_for(lambda: self.__fifo, timeout):
+                return None
             ret = self.__fifo.popleft()
-        except IndexError:
-            ret = None
+            self.__not_full.notify()
+            callback = self._check_low_watermark()
+        if callback is not None:
+            callback()
         return ret
 
-    def put(self, obj):
-        self.__fifo.append(obj)
+    def get_many(self, n, timeout=0, linger=0):
+        """
+        Get up to n objects from the buffer
+        timeout: seconds to wait for the first object to arrive; 0 not to wait, None to wait forever
+        linger: seconds to keep waiting after the first object arrives until n objects are available
+        return list of objects, empty if nothing arrives in time
+        """
+        ret = []
+        with self.__lock:
+            if not self.__not_empty.wait_for(lambda: self.__fifo, timeout):
+                return ret
+            if linger:
+                self.__not_empty.wait_for(lambda: len(self.__fifo) >= n, linger)
+            while self.__fifo and len(ret) < n:
+                ret.append(self.__fifo.popleft())
+            self.__not_full.notify(len(ret))
+            callback = self._check_low_watermark()
+        if callback is not None:
+            callback()
+        return ret
+
+    def put(self, obj, timeout=None):
+        """
+        Put an object into the buffer, blocking while the buffer is full
+        timeout: seconds to wait for a free slot; 0 not to wait, None to wait forever
+        return whether the object was put
+        """
+        with self.__lock:
+            if self.max_len is not None:
+                if not self.__not_full.wait_for(lambda: self.max_len is None or len(self.__fifo) < self.max_len, timeout):
+                    return False
+            self.__fifo.append(obj)
+            self.__not_empty.notify()
+            callback = self._check_high_watermark()
+        if callback is not None:
+            callback()
+        return True
 
 
 # message object
@@ -186,6 +315,85 @@ class MsgObj(object):
                 self.__mb_proxy._ack(self.conn_id, self.msg_id, self.ack_id)
 
 
+# batch of message objects
+class MsgBatch(object):
+    """
+    Batch of message objects from the same proxy, acknowledged together
+    Support with-statement: one transaction per connection is begun on enter and committed on exit
+    Messages marked with mark_failed() are NACKed individually while the others are ACKed
+    If an exception occurs, the transactions are aborted and no message is acknowledged,
+    so that the caller can fall back to process the messages one by one
+    """
+
+    def __init__(self, mb_proxy, msg_obj_list, is_transacted=True, cumulative_ack=False):
+        # associated proxy object
+        self.__mb_proxy = mb_proxy
+        # message objects
+        self.msg_obj_list = list(msg_obj_list)
+        # whether use transaction
+        self.is_transacted = is_transacted
+        # whether to acknowledge only the last message of each connection; effective only with client ack mode
+        self.cumulative_ack = cumulative_ack
+        # keys of failed messages
+        self.failed_keys = set()
+        # transaction ID for each connection
+        self.txs_id_map = {}
+
+    def __len__(self):
+        return len(self.msg_obj_list)
+
+    def __iter__(self):
+        return iter(self.msg_obj_list)
+
+    def mark_failed(self, msg_obj):
+        """
+        mark a message as failed, to be NACKed on exit
+        """
+        self.failed_keys.add((msg_obj.conn_id, msg_obj.msg_id))
+
+    def _group_by_connection(self):
+        """
+        return dict {conn_id: [msg_obj, ...]} keeping the order of messages
+        """
+        conn_map = {}
+        for msg_obj in self.msg_obj_list:
+            conn_map.setdefault(msg_obj.conn_id, []).append(msg_obj)
+        return conn_map
+
+    def __enter__(self):
+        if self.is_transacted:
+            for conn_id in self._group_by_connection():
+                self.txs_id_map[conn_id] = self.__mb_proxy._begin(conn_id)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type or exc_value:
+            # exception occurs, send abort and leave messages unacknowledged
+            for conn_id, txs_id in self.txs_id_map.items():
+                self.__mb_proxy._abort(conn_id, txs_id)
+            self.txs_id_map = {}
+            return
+        for conn_id, msg_obj_list in self._group_by_connection().items():
+            txs_id = self.txs_id_map.get(conn_id)
+            ok_list = []
+            failed_list = []
+            for msg_obj in msg_obj_list:
+                if (msg_obj.conn_id, msg_obj.msg_id) in self.failed_keys:
+                    failed_list.append(msg_obj)
+                else:
+                    ok_list.append(msg_obj)
+            if self.cumulative_ack and not failed_list and self.__mb_proxy.ack_mode == "client":
+                # ack of the last message acknowledges all previous ones
+                ok_list = ok_list[-1:]
+            for msg_obj in ok_list:
+                self.__mb_proxy._ack(conn_id, msg_obj.msg_id, msg_obj.ack_id, txs_id=txs_id)
+            for msg_obj in failed_list:
+                self.__mb_proxy._nack(conn_id, msg_obj.msg_id, msg_obj.ack_id, txs_id=txs_id)
+            if txs_id is not None:
+                self.__mb_proxy._commit(conn_id, txs_id)
+        self.txs_id_map = {}
+
+
 # message listener
 class MsgListener(stomp.ConnectionListener):
     """
@@ -229,7 +437,7 @@ class MsgListener(stomp.ConnectionListener):
         self.logger.debug("on_connected start")
         cmd, headers, body = self._parse_args(args)
         self.logger.debug("on_connected from {c}: {h} | {b}".format(c=self.conn_id, h=headers, b=body))
-        self.mb_proxy._on_connected(headers=headers)
+        self.mb_proxy._on_connected(headers=headers, conn_id=self.conn_id)
         self.logger.debug("on_connected done")
 
     def on_disconnected(self):
@@ -254,6 +462,12 @@ class MsgListener(stomp.ConnectionListener):
         if self.verbose:
             self.logger.debug("on_message done: {h}".format(h=headers))
 
+    def on_receipt(self, *args):
+        cmd, headers, body = self._parse_args(args)
+        if self.verbose:
+            self.logger.debug("on_receipt from {c}: {h}".format(c=self.conn_id, h=headers))
+        self.mb_proxy._on_receipt(headers, conn_id=self.conn_id)
+
 
 # message broker proxy base
 class MBProxyBase:
@@ -264,7 +478,14 @@ class MBProxyBase:
     def is_connected_to_rabbitmq(self):
         return getattr(self, "mq_server", None) and self.mq_server.startswith("RabbitMQ/")
 
-    def _on_connected(self, headers):
+    def _get_connected_event(self, conn_id):
+        """
+        get the event signalled when CONNECTED arrives on a connection
+        """
+        with self.connected_event_lock:
+            return self.connected_event_dict.setdefault(conn_id, threading.Event())
+
+    def _on_connected(self, headers, conn_id=None):
         # fill mq_server
         self.mq_server = headers.get("server")
         # rabbitmq
@@ -276,6 +497,62 @@ class MBProxyBase:
                 self.logger.debug(f"_on_connected : connected RabbitMQ; modified destination into {self.destination}")
         # done
         self.got_connected = True
+        if conn_id is not None:
+            self._get_connected_event(conn_id).set()
+
+    def _reset_health_state(self):
+        """
+        forget health of connections, e.g. after connections are renewed
+        """
+        with self.pool_lock:
+            self.healthy_conn_ids = []
+            self.n_failure_map = {}
+            self.retry_time_map = {}
+
+    def _mark_healthy(self, conn_id):
+        with self.pool_lock:
+            if conn_id not in self.healthy_conn_ids:
+                self.healthy_conn_ids.append(conn_id)
+            self.n_failure_map.pop(conn_id, None)
+            self.retry_time_map.pop(conn_id, None)
+
+    def _mark_unhealthy(self, conn_id):
+        """
+        take a connection out of the healthy ones and schedule its reconnection with backoff
+        return number of healthy connections left
+        """
+        with self.pool_lock:
+            if conn_id in self.healthy_conn_ids:
+                self.healthy_conn_ids.remove(conn_id)
+            n_failure = self.n_failure_map.get(conn_id, 0) + 1
+            self.n_failure_map[conn_id] = n_failure
+            delay = _get_backoff_delay(n_failure, self.reconnect_base_sec, self.reconnect_max_sec)
+            self.retry_time_map[conn_id] = time.monotonic() + delay
+            n_healthy = len(self.healthy_conn_ids)
+        self.logger.warning(
+            "took {0} out of healthy connections after {1} failures ; retry in {2:.1f} sec ; {3} healthy left".format(conn_id, n_failure, delay, n_healthy)
+        )
+        return n_healthy
+
+    def has_healthy_connections(self):
+        with self.pool_lock:
+            return len(self.healthy_conn_ids) > 0
+
+    def get_connection_states(self):
+        """
+        get dict {conn_id: state dict} of connections
+        """
+        time_now = time.monotonic()
+        with self.pool_lock:
+            ret = {}
+            for conn_id in self.connection_dict:
+                retry_time = self.retry_time_map.get(conn_id)
+                ret[conn_id] = {
+                    "healthy": conn_id in self.healthy_conn_ids,
+                    "n_failure": self.n_failure_map.get(conn_id, 0),
+                    "retry_in_sec": None if retry_time is None else max(retry_time - time_now, 0),
+                }
+            return ret
 
     def _on_disconnected(self, conn_id):
         self.logger.debug("_on_disconnected from {c} called".format(c=conn_id))
@@ -292,6 +569,9 @@ class MBProxyBase:
             self.restart()
             self.logger.debug(f"_on_error : restarted")
 
+    def _on_receipt(self, headers, conn_id):
+        pass
+
 
 # message broker proxy for receiver
 class MBListenerProxy(MBProxyBase):
@@ -313,11 +593,16 @@ class MBListenerProxy(MBProxyBase):
         prefetch_size=None,
         max_buffer_len=999,
         buffer_block_sec=10,
+        high_watermark=None,
+        low_watermark=None,
+        pause_on_high_watermark=False,
         use_transaction=True,
         verbose=False,
         keepalive=True,
         send_heartbeat_ms=60000,
         recv_heartbeat_ms=0,
+        reconnect_base_sec=1,
+        reconnect_max_sec=300,
         **kwargs,
     ):
         # logger
@@ -355,8 +640,20 @@ class MBListenerProxy(MBProxyBase):
         self.msg_buffer = MsgBuffer(queue_name=self.name)
         # max length before blocking put to buffer
         self.max_buffer_len = max_buffer_len
-        # put retry period in seconds to wait for blocking
+        # max period in seconds to block put before logging and retrying
         self.buffer_block_sec = buffer_block_sec
+        # whether to unsubscribe when the buffer reaches the high watermark and resubscribe when it drains to the low watermark
+        self.pause_on_high_watermark = pause_on_high_watermark
+        # whether delivery is paused
+        self.paused = False
+        # lock for pause and resume
+        self.pause_lock = threading.Lock()
+        # set capacity and watermarks of the buffer
+        if high_watermark is None and max_buffer_len is not None:
+            high_watermark = max(max_buffer_len * 4 // 5, 1)
+        self.msg_buffer.set_limits(max_len=max_buffer_len, high_watermark=high_watermark, low_watermark=low_watermark)
+        if self.pause_on_high_watermark:
+            self.msg_buffer.set_watermark_callbacks(on_high=self.pause, on_low=self.resume)
         # whether to enable transaction of message broker to wrap the message processing
         self.use_transaction = use_transaction
         # connection mode; "all" or "any"
@@ -373,7 +670,24 @@ class MBListenerProxy(MBProxyBase):
         self.n_restart = 0
         # whether got connected from on_connected
         self.got_connected = False
-        # whether got disconnected from on_disconnected
+        # events signalled from on_connected for each connection, and their lock
+        self.connected_event_dict = {}
+        self.connected_event_lock = threading.Lock()
+        # max seconds to wait for on_connected before subscribing
+        self.connected_wait_sec = 3
+        # backoff parameters in seconds to reconnect failed connections
+        self.reconnect_base_sec = reconnect_base_sec
+        self.reconnect_max_sec = reconnect_max_sec
+        # lock for health state of connections
+        self.pool_lock = threading.Lock()
+        # IDs of healthy connections
+        self.healthy_conn_ids = []
+        # number of failures and time to retry for failed connections
+        self.n_failure_map = {}
+        self.retry_time_map = {}
+        # IDs of connections being reconnected
+        self.reconnecting_conn_ids = set()
+        # whether got disconnected from on_disconnected, i.e. some connections need to reconnect
         self.got_disconnected = False
         # whether to disconnect intentionally
         self.to_disconnect = False
@@ -418,6 +732,7 @@ class MBListenerProxy(MBProxyBase):
             listener = MsgListener(mb_proxy=self, conn_id=conn_id, verbose=self.verbose)
             self.listener_dict[conn_id] = listener
             self.logger.debug("got connection about {0}".format(conn_id))
+        self._reset_health_state()
         self.logger.debug("done")
 
     def _evaluate_subscription_headers(self):
@@ -448,18 +763,18 @@ class MBListenerProxy(MBProxyBase):
         conn.abort(txs_id)
         self.logger.warning("{conid} txid={txid} ABORT".format(conid=conn_id, txid=txs_id))
 
-    def _ack(self, conn_id, msg_id, ack_id):
+    def _ack(self, conn_id, msg_id, ack_id, txs_id=None):
         if self.ack_mode in ["client", "client-individual"]:
             conn = self.connection_dict[conn_id]
-            conn.ack(ack_id)
+            conn.ack(ack_id, transaction=txs_id)
             if self.verbose:
-                self.logger.debug("{conid} {mid} {ackid} ACK".format(conid=conn_id, mid=msg_id, ackid=ack_id))
+                self.logger.debug("{conid} {mid} {ackid} txid={txid} ACK".format(conid=conn_id, mid=msg_id, ackid=ack_id, txid=txs_id))
 
-    def _nack(self, conn_id, msg_id, ack_id):
+    def _nack(self, conn_id, msg_id, ack_id, txs_id=None):
         if self.ack_mode in ["client", "client-individual"]:
             conn = self.connection_dict[conn_id]
-            conn.nack(ack_id)
-            self.logger.warning("{conid} {mid} {ackid} NACK".format(conid=conn_id, mid=msg_id, ackid=ack_id))
+            conn.nack(ack_id, transaction=txs_id)
+            self.logger.warning("{conid} {mid} {ackid} txid={txid} NACK".format(conid=conn_id, mid=msg_id, ackid=ack_id, txid=txs_id))
 
     def _on_message(self, headers, body, conn_id):
         msg_obj = MsgObj(mb_proxy=self, conn_id=conn_id, msg_id=headers["message-id"], ack_id=headers.get("ack"), data=body, is_transacted=self.use_transaction)
@@ -471,48 +786,145 @@ class MBListenerProxy(MBProxyBase):
             self.dump_msgs.append(msg_obj.data)
             self._ack(msg_obj.conn_id, msg_obj.msg_id, msg_obj.ack_id)
         else:
-            to_block = True
-            while to_block:
-                n_buffered_msg = self.msg_buffer.size()
-                if n_buffered_msg >= self.max_buffer_len:
-                    if self.verbose:
-                        self.logger.debug("_on_message too many buffered messages ({nbm}); waiting...".format(nbm=n_buffered_msg))
-                    time.sleep(self.buffer_block_sec)
-                else:
-                    to_block = False
-            self.msg_buffer.put(msg_obj)
+            # block until a consumer frees a slot
+            while not self.msg_buffer.put(msg_obj, timeout=self.buffer_block_sec):
+                if self.verbose:
+                    n_buffered_msg = self.msg_buffer.size()
+                    self.logger.debug("_on_message too many buffered messages ({nbm}); waiting...".format(nbm=n_buffered_msg))
             if self.verbose:
                 n_buffered_msg = self.msg_buffer.size()
                 self.logger.debug("_on_message put into buffer ({nbm}): {h}".format(nbm=n_buffered_msg, h=headers))
 
+    def pause(self):
+        """
+        pause delivery by unsubscribing from all connections; buffered messages can still be acknowledged
+        """
+        with self.pause_lock:
+            if self.paused:
+                return
+            self.paused = True
+            for conn_id, conn in self.connection_dict.items():
+                try:
+                    if conn.is_connected():
+                        conn.unsubscribe(id=self.sub_id)
+                except Exception as e:
+                    self.logger.error("failed to unsubscribe from {0} {1} ; {2}: {3}".format(conn_id, self.destination, e.__class__.__name__, e))
+            self.logger.info("paused delivery from {0} with {1} buffered messages".format(self.destination, self.msg_buffer.size()))
+
+    def resume(self):
+        """
+        resume delivery paused by pause()
+        """
+        with self.pause_lock:
+            if not self.paused:
+                return
+            self.paused = False
+            for conn_id, conn in self.connection_dict.items():
+                try:
+                    if conn.is_connected():
+                        conn.subscribe(destination=self.destination, id=self.sub_id, ack=self.ack_mode, headers=self.subscription_headers)
+                except Exception as e:
+                    self.logger.error("failed to resubscribe to {0} {1} ; {2}: {3}".format(conn_id, self.destination, e.__class__.__name__, e))
+            self.logger.info("resumed delivery from {0} with {1} buffered messages".format(self.destination, self.msg_buffer.size()))
+
+    def _connect_and_subscribe(self, conn_id, conn):
+        """
+        connect to a broker and subscribe the destination once on_connected is done
+        return whether the connection is ready
+        """
+        if conn.is_connected():
+            self.logger.info("connection to {0} {1} already exists. Skipped...".format(conn_id, self.destination))
+            return True
+        listener = self.listener_dict[conn_id]
+        connected_event = self._get_connected_event(conn_id)
+        connected_event.clear()
+        conn.set_listener(listener.__class__.__name__, listener)
+        conn.connect(**self.connect_params)
+        # wait for on_connected done before subscribe, since it may change the destination
+        if not connected_event.wait(self.connected_wait_sec):
+            self.logger.warning(f"on_connected from {conn_id} did not come in {self.connected_wait_sec} sec ; subscribing anyway")
+        self.logger.debug(f"connected to {conn_id}, subscribing...")
+        with self.dest_lock:
+            conn.subscribe(destination=self.destination, id=self.sub_id, ack=self.ack_mode, headers=self.subscription_headers)
+        self.logger.info(f"connected to {conn_id} and subscribed {self.destination}")
+        return True
+
+    def _connect_in_parallel(self, conn_ids):
+        """
+        connect and subscribe some connections in parallel so that slow or dead brokers do not delay the others
+        return list of IDs of failed connections
+        """
+        failed_conn_ids = []
+        if not conn_ids:
+            return failed_conn_ids
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(conn_ids)) as executor:
+            future_map = {executor.submit(self._connect_and_subscribe, conn_id, self.connection_dict[conn_id]): conn_id for conn_id in conn_ids}
+            for future in concurrent.futures.as_completed(future_map):
+                conn_id = future_map[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    tb_str = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+                    self.logger.error("failed to start connection to {0} {1} ; {2} \n{3}".format(conn_id, self.destination, e.__class__.__name__, tb_str))
+                    failed_conn_ids.append(conn_id)
+                    self._mark_unhealthy(conn_id)
+                else:
+                    self._mark_healthy(conn_id)
+        return failed_conn_ids
+
     def go(self):
         self.logger.debug("go called")
         self.to_disconnect = False
+        self.paused = False
+        self.got_disconnected = False
         self.logger.debug(f"last destination is {self.destination}, new destination is {self.new_destination}")
         self.destination = self.new_destination
-        for conn_id, conn in self.connection_dict.items():
+        if not self.connection_dict:
+            self.got_disconnected = True
+            return
+        failed_conn_ids = self._connect_in_parallel(list(self.connection_dict))
+        if failed_conn_ids:
+            self.logger.warning("{0}/{1} connections failed: {2}".format(len(failed_conn_ids), len(self.connection_dict), ",".join(failed_conn_ids)))
+            self.got_disconnected = True
+
+    def _on_disconnected(self, conn_id):
+        self.logger.debug("_on_disconnected from {c} called".format(c=conn_id))
+        if self.to_disconnect:
+            return
+        with self.pool_lock:
+            if conn_id in self.reconnecting_conn_ids:
+                return
+        self._mark_unhealthy(conn_id)
+        self.got_disconnected = True
+
+    def reconnect_failed(self):
+        """
+        reconnect only failed connections whose backoff expired, while healthy connections keep delivering
+        return number of connections still failed
+        """
+        time_now = time.monotonic()
+        with self.pool_lock:
+            due_conn_ids = [conn_id for conn_id, retry_time in self.retry_time_map.items() if retry_time <= time_now]
+        if due_conn_ids:
+            self.logger.debug("reconnecting {0}".format(",".join(due_conn_ids)))
+            with self.pool_lock:
+                self.reconnecting_conn_ids.update(due_conn_ids)
             try:
-                if not conn.is_connected():
-                    listener = self.listener_dict[conn_id]
-                    self.got_disconnected = False
-                    conn.set_listener(listener.__class__.__name__, listener)
-                    with self.dest_lock:
-                        conn.connect(**self.connect_params)
-                        # wait for on_connected done for a while before subscribe
-                        for wait_i in range(100):
-                            if self.got_connected:
-                                break
-                            time.sleep(0.003)
-                        self.logger.debug(f"connected to {conn_id}, subscribing...")
-                        conn.subscribe(destination=self.destination, id=self.sub_id, ack=self.ack_mode, headers=self.subscription_headers)
-                        self.logger.info(f"connected to {conn_id} and subscribed {self.destination}")
-                else:
-                    self.logger.info("connection to {0} {1} already exists. Skipped...".format(conn_id, self.destination))
+                # drop half-open connections before connecting again
+                for conn_id in due_conn_ids:
+                    conn = self.connection_dict[conn_id]
+                    if conn.is_connected():
+                        conn.disconnect()
+                self._connect_in_parallel(due_conn_ids)
             except Exception as e:
-                tb_str = traceback.format_exc()
-                self.logger.error("failed to start connection to {0} {1} ; {2} \n{3}".format(conn_id, self.destination, e.__class__.__name__, tb_str))
-                self.got_disconnected = True
-                break
+                self.logger.error("failed to reconnect {0} ; {1}: {2}".format(",".join(due_conn_ids), e.__class__.__name__, e))
+            finally:
+                with self.pool_lock:
+                    self.reconnecting_conn_ids.difference_update(due_conn_ids)
+        with self.pool_lock:
+            n_failed = len(self.retry_time_map)
+        self.got_disconnected = n_failed > 0
+        return n_failed
 
     def stop(self):
         self.logger.debug("stop called")
@@ -532,24 +944,34 @@ class MBListenerProxy(MBProxyBase):
         self.go()
         self.logger.info("the {0}th restart ended".format(self.n_restart))
 
-    def get_messages(self, limit=100):
+    def get_messages(self, limit=100, timeout=0):
         """
         get some messages capped by limit from local buffer
+        timeout: seconds to wait for the first message to arrive; 0 not to wait
         return list of message objects
         """
         if self.verbose:
             self.logger.debug("get_messages called")
         # get messages from local buffer
-        msg_list = []
-        for j in range(limit):
-            msg_obj = self.msg_buffer.get()
-            if msg_obj is None:
-                break
-            msg_list.append(msg_obj)
+        msg_list = self.msg_buffer.get_many(limit, timeout=timeout)
         if self.verbose:
             self.logger.debug("got {n} messages".format(n=len(msg_list)))
         return msg_list
 
+    def get_msg_batch(self, limit=100, timeout=0, linger_ms=0, cumulative_ack=False):
+        """
+        get a batch of messages capped by limit from local buffer, to be acknowledged in one transaction
+        timeout: seconds to wait for the first message to arrive; 0 not to wait
+        linger_ms: milliseconds to keep waiting after the first message until limit messages are available
+        cumulative_ack: whether to ACK only the last message of each connection with client ack mode;
+                        safe only when a single consumer takes messages from the buffer
+        return MsgBatch object, which can be empty
+        """
+        msg_list = self.msg_buffer.get_many(limit, timeout=timeout, linger=linger_ms / 1000)
+        if self.verbose:
+            self.logger.debug("got a batch of {n} messages".format(n=len(msg_list)))
+        return MsgBatch(mb_proxy=self, msg_obj_list=msg_list, is_transacted=self.use_transaction, cumulative_ack=cumulative_ack)
+
 
 # message broker proxy for sender, waster...
 class MBSenderProxy(MBProxyBase):
@@ -569,6 +991,17 @@ class MBSenderProxy(MBProxyBase):
         keepalive=True,
         send_heartbeat_ms=60000,
         recv_heartbeat_ms=0,
+        async_send=False,
+        max_outbound_len=10000,
+        outbound_block_sec=10,
+        max_coalesced_frames=100,
+        max_retries=3,
+        receipt_window=0,
+        receipt_timeout_sec=60,
+        conn_mode="any",
+        send_policy="round_robin",
+        reconnect_base_sec=1,
+        reconnect_max_sec=300,
         **kwargs,
     ):
         # logger
@@ -619,12 +1052,73 @@ class MBSenderProxy(MBProxyBase):
         self.remover_lock = threading.Lock()
         # removers
         self.removers = {}
+        # whether to send through outbound queue and writer thread instead of sending on the caller thread
+        self.async_send = async_send
+        # outbound queue
+        self.outbound_queue = Queue(maxsize=max_outbound_len)
+        # max period in seconds to block send when the outbound queue is full
+        self.outbound_block_sec = outbound_block_sec
+        # max number of frames written to socket at once
+        self.max_coalesced_frames = max_coalesced_frames
+        # max number of times to retry a batch which failed to be written by the writer thread
+        self.max_retries = max_retries
+        # batch which failed to be written, retried before messages in the outbound queue, and the number of its retries
+        self.retry_msg_list = []
+        self.n_retries = 0
+        # max number of frames sent without receipt; 0 not to request receipts
+        self.receipt_window = receipt_window
+        # condition for pending messages and outstanding receipts
+        self.outbound_cond = threading.Condition()
+        # number of messages in outbound queue or being written
+        self.n_pending = 0
+        # receipt IDs waiting for confirmation and their (connection ID, time sent)
+        self.outstanding_receipts = {}
+        # max seconds to wait for a receipt before giving it up, and time of the next check
+        self.receipt_timeout_sec = receipt_timeout_sec
+        self.next_receipt_check_time = 0
+        # number of messages dropped in async mode
+        self.n_dropped = 0
+        # writer thread and its stop event
+        self.writer_thread = None
+        self.writer_stop_event = None
+        # lock held by the writer thread while writing a batch, so that an old writer being stopped never interleaves with a new one
+        self.writer_lock = threading.Lock()
+        # max seconds to wait for the writer thread to stop
+        self.writer_join_sec = 10
+        # connection mode; "any" to send through one broker, "all" to spread sends over all brokers behind hostnames
+        self.conn_mode = conn_mode
+        # how to choose a broker in "all" mode; "round_robin" or "least_outstanding" where receipts are requested to count frames in flight
+        self.send_policy = send_policy
+        # backoff parameters in seconds to reconnect unhealthy brokers in "all" mode
+        self.reconnect_base_sec = reconnect_base_sec
+        self.reconnect_max_sec = reconnect_max_sec
+        # events signalled from on_connected for each connection, and their lock
+        self.connected_event_dict = {}
+        self.connected_event_lock = threading.Lock()
+        # max seconds to wait for on_connected before subscribing
+        self.connected_wait_sec = 3
+        # lock for connection pool
+        self.pool_lock = threading.Lock()
+        # connection pool
+        self.connection_dict = {}
+        self.listener_dict = {}
+        # IDs of healthy connections
+        self.healthy_conn_ids = []
+        # number of frames being written or waiting for receipts for each connection
+        self.n_outstanding_map = {}
+        # number of failures and time to retry for unhealthy connections
+        self.n_failure_map = {}
+        self.retry_time_map = {}
+        # IDs of connections being reconnected
+        self.reconnecting_conn_ids = set()
+        # index for round robin
+        self.rr_index = 0
         # get connection
         self._get_connection()
 
     def _get_connection(self):
         """
-        get a connection and a listener
+        get connections and listeners; the primary connection is used for removers
         """
         conn_dict = _get_connection_dict(
             self.host_port_list,
@@ -638,15 +1132,186 @@ class MBSenderProxy(MBProxyBase):
         )
         self.conn_id, self.conn = random.choice(list(conn_dict.items()))
         self.listener = MsgListener(mb_proxy=self, conn_id=self.conn_id, verbose=self.verbose)
-        self.logger.debug("got connection about {0}".format(self.conn_id))
+        with self.pool_lock:
+            if self.conn_mode == "all":
+                self.connection_dict = conn_dict
+            else:
+                self.connection_dict = {self.conn_id: self.conn}
+            self.listener_dict = {self.conn_id: self.listener}
+            for conn_id in self.connection_dict:
+                if conn_id not in self.listener_dict:
+                    self.listener_dict[conn_id] = MsgListener(mb_proxy=self, conn_id=conn_id, verbose=self.verbose)
+            self.n_outstanding_map = {conn_id: 0 for conn_id in self.connection_dict}
+            self.reconnecting_conn_ids = set()
+        self._reset_health_state()
+        self.logger.debug("got connection about {0}".format(" , ".join(self.connection_dict)))
+
+    def get_connection_states(self):
+        """
+        get dict {conn_id: state dict} of connections in the pool
+        """
+        ret = MBProxyBase.get_connection_states(self)
+        with self.pool_lock:
+            for conn_id, state in ret.items():
+                state["n_outstanding"] = self.n_outstanding_map.get(conn_id, 0)
+                state["primary"] = conn_id == self.conn_id
+        return ret
+
+    def _revive_connections(self):
+        """
+        reconnect unhealthy connections in the background once their backoff expires, with pool_lock held by the caller
+        """
+        time_now = time.monotonic()
+        for conn_id, retry_time in self.retry_time_map.items():
+            if retry_time <= time_now and conn_id not in self.reconnecting_conn_ids:
+                self.reconnecting_conn_ids.add(conn_id)
+                threading.Thread(target=self._reconnect, args=(conn_id,), daemon=True).start()
+
+    def _reconnect(self, conn_id):
+        try:
+            conn = self.connection_dict[conn_id]
+            if not conn.is_connected():
+                self._connect(conn_id, conn)
+            if conn.is_connected():
+                self._mark_healthy(conn_id)
+                self.logger.info("reintroduced {0} into the pool".format(conn_id))
+            else:
+                self._mark_unhealthy(conn_id)
+        except Exception as e:
+            self.logger.error("failed to reconnect to {0} ; {1}: {2}".format(conn_id, e.__class__.__name__, e))
+            self._mark_unhealthy(conn_id)
+        finally:
+            with self.pool_lock:
+                self.reconnecting_conn_ids.discard(conn_id)
+
+    def _acquire_connection(self, n_frames):
+        """
+        choose a connection to send through and count frames as outstanding
+        return (conn_id, conn)
+        """
+        with self.pool_lock:
+            if self.conn_mode == "all" and self.retry_time_map:
+                self._revive_connections()
+            if not self.healthy_conn_ids:
+                conn_id = self.conn_id
+            elif self.send_policy == "least_outstanding":
+                # round robin among connections with the fewest frames in flight
+                n_min = min(self.n_outstanding_map.get(tmp_conn_id, 0) for tmp_conn_id in self.healthy_conn_ids)
+                n_conns = len(self.healthy_conn_ids)
+                for i in range(1, n_conns + 1):
+                    index = (self.rr_index + i) % n_conns
+                    if self.n_outstanding_map.get(self.healthy_conn_ids[index], 0) == n_min:
+                        break
+                self.rr_index = index
+                conn_id = self.healthy_conn_ids[index]
+            else:
+                self.rr_index = (self.rr_index + 1) % len(self.healthy_conn_ids)
+                conn_id = self.healthy_conn_ids[self.rr_index]
+            self.n_outstanding_map[conn_id] = self.n_outstanding_map.get(conn_id, 0) + n_frames
+            return conn_id, self.connection_dict.get(conn_id, self.conn)
+
+    def _release_connection(self, conn_id, n_frames=1):
+        with self.pool_lock:
+            if conn_id in self.n_outstanding_map:
+                self.n_outstanding_map[conn_id] = max(self.n_outstanding_map[conn_id] - n_frames, 0)
+
+    def _expire_receipts(self):
+        """
+        give up receipts not confirmed in receipt_timeout_sec, releasing their connections; checked at most once per second
+        """
+        time_now = time.monotonic()
+        with self.outbound_cond:
+            if time_now < self.next_receipt_check_time:
+                return
+            self.next_receipt_check_time = time_now + 1
+            expired_list = [
+                (receipt_id, conn_id)
+                for receipt_id, (conn_id, sent_time) in self.outstanding_receipts.items()
+                if sent_time + self.receipt_timeout_sec <= time_now
+            ]
+            for receipt_id, conn_id in expired_list:
+                del self.outstanding_receipts[receipt_id]
+            if expired_list:
+                self.outbound_cond.notify_all()
+        if expired_list:
+            self.logger.warning("gave up {0} receipts not confirmed in {1} sec".format(len(expired_list), self.receipt_timeout_sec))
+            for receipt_id, conn_id in expired_list:
+                self._release_connection(conn_id)
+
+    def _send_through_pool(self, msg_list, coalesce):
+        """
+        write messages through a connection chosen from the pool, trying other connections on failure
+        frames with receipts stay outstanding on the connection until their receipts come, time out, or the connection is lost
+        """
+        if self.send_policy == "least_outstanding":
+            for data, headers_dict in msg_list:
+                headers_dict.setdefault(stomp.utils.HDR_RECEIPT, str(uuid.uuid4()))
+        receipt_id_list = [headers_dict[stomp.utils.HDR_RECEIPT] for data, headers_dict in msg_list if stomp.utils.HDR_RECEIPT in headers_dict]
+        if receipt_id_list:
+            self._expire_receipts()
+        err = None
+        for i_try in range(max(len(self.connection_dict), 1)):
+            conn_id, conn = self._acquire_connection(len(msg_list))
+            if receipt_id_list:
+                with self.outbound_cond:
+                    time_now = time.monotonic()
+                    for receipt_id in receipt_id_list:
+                        self.outstanding_receipts[receipt_id] = (conn_id, time_now)
+            try:
+                self._write_frames(conn, msg_list, coalesce)
+            except Exception as e:
+                err = e
+                with self.outbound_cond:
+                    n_unconfirmed = len(msg_list) - len(receipt_id_list)
+                    for receipt_id in receipt_id_list:
+                        if self.outstanding_receipts.pop(receipt_id, None) is not None:
+                            n_unconfirmed += 1
+                self._release_connection(conn_id, n_unconfirmed)
+                if self._mark_unhealthy(conn_id) == 0:
+                    break
+            else:
+                # frames without receipts are done once written
+                self._release_connection(conn_id, len(msg_list) - len(receipt_id_list))
+                if self.verbose:
+                    self.logger.debug("sent {0} messages through {1}".format(len(msg_list), conn_id))
+                return
+        raise err
 
     def _on_message(self, headers, body, conn_id):
         if self.verbose:
             self.logger.debug("_on_message from {c} drop message: {h} | {b}".format(c=conn_id, h=headers, b=body))
 
+    def _on_disconnected(self, conn_id):
+        self.logger.debug("_on_disconnected from {c} called".format(c=conn_id))
+        # receipts never come after disconnection
+        with self.outbound_cond:
+            lost_receipts = [receipt_id for receipt_id, (tmp_conn_id, sent_time) in self.outstanding_receipts.items() if tmp_conn_id == conn_id]
+            if lost_receipts:
+                self.logger.warning("{0} sent messages were not confirmed by receipt before disconnection from {1}".format(len(lost_receipts), conn_id))
+                for receipt_id in lost_receipts:
+                    del self.outstanding_receipts[receipt_id]
+                self.outbound_cond.notify_all()
+        if lost_receipts:
+            self._release_connection(conn_id, len(lost_receipts))
+        if self.to_disconnect:
+            return
+        # take the connection out of the pool; restart is needed only when no connection is left
+        if self._mark_unhealthy(conn_id) == 0:
+            self.got_disconnected = True
+
+    def _on_receipt(self, headers, conn_id):
+        receipt_id = headers.get("receipt-id")
+        with self.outbound_cond:
+            receipt = self.outstanding_receipts.pop(receipt_id, None)
+            if receipt is not None:
+                self.outbound_cond.notify_all()
+        if receipt is not None:
+            self._release_connection(receipt[0])
+
     def send(self, data, headers=None, **kwargs):
         """
         send a message to queue
+        in async mode, the message is put into the outbound queue and written by the writer thread
         """
         if data is None:
             self.logger.debug("got None, not to send")
@@ -655,8 +1320,11 @@ class MBSenderProxy(MBProxyBase):
             if headers is not None:
                 headers_dict.update(headers)
             headers_dict.update(kwargs)
+            if self.async_send:
+                self._enqueue(data, headers_dict)
+                return
             try:
-                self.conn.send(destination=self.destination, body=data, headers=headers_dict)
+                self._send_through_pool([(data, headers_dict)], coalesce=False)
             except Exception as e:
                 tb_str = traceback.format_exc()
                 self.logger.error(
@@ -668,6 +1336,174 @@ class MBSenderProxy(MBProxyBase):
                 if self.verbose:
                     self.logger.debug("send to {dest} | {data}".format(dest=self.destination, data=data))
 
+    def _enqueue(self, data, headers_dict):
+        """
+        put a message into the outbound queue, blocking while the queue is full
+        """
+        with self.outbound_cond:
+            self.n_pending += 1
+        try:
+            self.outbound_queue.put((data, headers_dict), timeout=self.outbound_block_sec)
+        except Full:
+            with self.outbound_cond:
+                self.n_pending -= 1
+                self.n_dropped += 1
+                self.outbound_cond.notify_all()
+            self.logger.error("outbound queue is full for {0} sec; dropped message to {1} ; data={2}".format(self.outbound_block_sec, self.destination, data))
+        else:
+            if self.verbose:
+                self.logger.debug("queued to {dest} | {data}".format(dest=self.destination, data=data))
+
+    def _pack_frames(self, conn, transport, msg_list):
+        """
+        pack SEND frames into bytes to be written at once
+        headers are built and escaped, and on_send of listeners is called, as stomp.py does for each frame
+        """
+        with transport._BaseTransport__listeners_change_condition:
+            listeners = sorted(transport.listeners.items())
+        packed_list = []
+        for data, headers_dict in msg_list:
+            headers = dict(headers_dict)
+            headers[stomp.utils.HDR_DESTINATION] = self.destination
+            if conn.auto_content_length and data and stomp.utils.HDR_CONTENT_LENGTH not in headers:
+                headers[stomp.utils.HDR_CONTENT_LENGTH] = len(data)
+            conn._escape_headers(headers)
+            frame = stomp.utils.Frame(stomp.utils.CMD_SEND, headers, data)
+            for _, listener in listeners:
+                try:
+                    listener.on_send(frame)
+                except AttributeError:
+                    continue
+            packed_list.append(stomp.utils.pack(stomp.utils.convert_frame(frame)))
+        return b"".join(packed_list)
+
+    def _write_frames(self, conn, msg_list, coalesce=True):
+        """
+        write messages, coalescing frames into a single socket write with the supported version of stomp.py
+        """
+        if coalesce and _CAN_COALESCE_FRAMES:
+            try:
+                transport = conn.transport
+                packed = self._pack_frames(conn, transport, msg_list)
+            except Exception as e:
+                self.logger.warning("failed to pack frames ; {0}: {1} ; send them one by one".format(e.__class__.__name__, e))
+            else:
+                transport.send(packed)
+                return
+        for data, headers_dict in msg_list:
+            conn.send(destination=self.destination, body=data, headers=headers_dict)
+
+    def _write_loop(self, stop_event):
+        """
+        main loop of writer thread
+        """
+        while not stop_event.is_set():
+            # wait for reconnection without losing messages
+            if not any(conn.is_connected() for conn in list(self.connection_dict.values())):
+                time.sleep(0.1)
+                continue
+            with self.writer_lock:
+                if stop_event.is_set():
+                    break
+                self._write_batch(stop_event)
+
+    def _write_batch(self, stop_event):
+        """
+        take a batch of messages from the outbound queue and write them, with writer_lock held
+        a batch which failed to be written is retried first, up to max_retries times
+        """
+        if self.retry_msg_list:
+            msg_list = self.retry_msg_list
+            self.retry_msg_list = []
+        else:
+            try:
+                msg_list = [self.outbound_queue.get(timeout=1)]
+            except Empty:
+                return
+            # cap the batch so that frames without receipt never exceed the receipt window
+            max_frames = self.max_coalesced_frames
+            if self.receipt_window:
+                while True:
+                    with self.outbound_cond:
+                        if self.outbound_cond.wait_for(lambda: len(self.outstanding_receipts) < self.receipt_window or stop_event.is_set(), 1):
+                            max_frames = min(max_frames, max(self.receipt_window - len(self.outstanding_receipts), 1))
+                            break
+                    self._expire_receipts()
+            while len(msg_list) < max_frames:
+                try:
+                    msg_list.append(self.outbound_queue.get_nowait())
+                except Empty:
+                    break
+        # receipts
+        if self.receipt_window:
+            for data, headers_dict in msg_list:
+                headers_dict[stomp.utils.HDR_RECEIPT] = str(uuid.uuid4())
+        try:
+            self._send_through_pool(msg_list, coalesce=True)
+        except Exception as e:
+            if self.n_retries < self.max_retries:
+                # keep the batch ahead of the outbound queue, also across restart
+                self.n_retries += 1
+                self.retry_msg_list = msg_list
+                delay = _get_backoff_delay(self.n_retries, 1, 10)
+                self.logger.warning(
+                    "failed to send {0} messages to {1} ; {2}: {3} ; retry {4}/{5} in {6:.1f} sec".format(
+                        len(msg_list), self.destination, e.__class__.__name__, e, self.n_retries, self.max_retries, delay
+                    )
+                )
+                stop_event.wait(delay)
+                return
+            with self.outbound_cond:
+                self.n_dropped += len(msg_list)
+            self.logger.error(
+                "failed to send {0} messages to {1} after {2} retries ; dropped ; {3}: {4}".format(
+                    len(msg_list), self.destination, self.max_retries, e.__class__.__name__, e
+                )
+            )
+        else:
+            if self.verbose:
+                self.logger.debug("sent {0} messages to {1}".format(len(msg_list), self.destination))
+        self.n_retries = 0
+        with self.outbound_cond:
+            self.n_pending -= len(msg_list)
+            self.outbound_cond.notify_all()
+
+    def _start_writer(self):
+        if self.async_send and self.writer_thread is None:
+            self.writer_stop_event = threading.Event()
+            self.writer_thread = threading.Thread(
+                target=self._write_loop, args=(self.writer_stop_event,), name="MBSenderProxy-writer-{0}".format(self.name), daemon=True
+            )
+            self.writer_thread.start()
+
+    def _stop_writer(self, flush_timeout):
+        if self.writer_thread is not None:
+            # write remaining messages before stopping
+            if flush_timeout:
+                self.flush(flush_timeout)
+            self.writer_stop_event.set()
+            with self.outbound_cond:
+                self.outbound_cond.notify_all()
+            # wait for the current batch to be written before connections are torn down
+            self.writer_thread.join(self.writer_join_sec)
+            if self.writer_thread.is_alive():
+                self.logger.warning(
+                    "writer thread did not stop in {0} sec ; a new writer waits until it finishes the current batch".format(self.writer_join_sec)
+                )
+            self.writer_thread = None
+
+    def flush(self, timeout=None):
+        """
+        wait until all queued messages are written and, when receipts are requested, confirmed
+        timeout: max seconds to wait; None to wait forever
+        return whether all messages are done
+        """
+        with self.outbound_cond:
+            is_done = self.outbound_cond.wait_for(lambda: self.n_pending <= 0 and not self.outstanding_receipts, timeout)
+        if not is_done:
+            self.logger.warning("flush timed out with {0} pending messages and {1} unconfirmed receipts".format(self.n_pending, len(self.outstanding_receipts)))
+        return is_done
+
     def waste(self, duration=3):
         """
         drop all messages gotten during duration time
@@ -677,48 +1513,68 @@ class MBSenderProxy(MBProxyBase):
         self.conn.unsubscribe(id=self.sub_id)
         self.logger.debug("waste dropped messages for {t} sec".format(t=duration))
 
+    def _connect(self, conn_id, conn):
+        """
+        connect to a broker; removers are subscribed only through the primary connection
+        """
+        connected_event = self._get_connected_event(conn_id)
+        connected_event.clear()
+        conn.set_listener(MsgListener.__name__, self.listener_dict[conn_id])
+        with self.dest_lock:
+            conn.connect(**self.connect_params)
+            # wait for on_connected done before subscribe
+            if not connected_event.wait(self.connected_wait_sec):
+                self.logger.warning(f"on_connected from {conn_id} did not come in {self.connected_wait_sec} sec")
+            self.logger.debug(f"connected to {conn_id}")
+            # add removers
+            if conn_id == self.conn_id:
+                with self.remover_lock:
+                    for r_id in self.removers:
+                        headers = self.removers[r_id]["headers"]
+                        conn.subscribe(destination=self.destination, headers=headers, id=r_id, ack="auto")
+            self.logger.info(f"connected to {conn_id} and ready to send to {self.destination}")
+
     def go(self):
         self.logger.debug("go called")
         self.to_disconnect = False
         self.logger.debug(f"last destination is {self.destination}, new destination is {self.new_destination}")
         self.destination = self.new_destination
-        try:
-            if not self.conn.is_connected():
-                self.got_disconnected = False
-                self.conn.set_listener(self.listener.__class__.__name__, self.listener)
-                with self.dest_lock:
-                    self.conn.connect(**self.connect_params)
-                    # wait for on_connected done for a while before subscribe
-                    for wait_i in range(100):
-                        if self.got_connected:
-                            break
-                        time.sleep(0.003)
-                    self.logger.debug(f"connected to {self.conn_id}")
-                    # add removers
-                    with self.remover_lock:
-                        for r_id in self.removers:
-                            headers = self.removers[r_id]["headers"]
-                            self.conn.subscribe(destination=self.destination, headers=headers, id=r_id, ack="auto")
-                    self.logger.info(f"connected to {self.conn_id} and ready to send to {self.destination}")
-            else:
-                self.logger.info("connection to {0} {1} already exists. Skipped...".format(self.conn_id, self.destination))
-        except Exception as e:
-            tb_str = traceback.format_exc()
-            self.logger.error("failed to start connection to {0} {1} ; {2} \n{3}".format(self.conn_id, self.destination, e.__class__.__name__, tb_str))
+        self._start_writer()
+        self.got_disconnected = False
+        for conn_id, conn in self.connection_dict.items():
+            try:
+                if not conn.is_connected():
+                    self._connect(conn_id, conn)
+                else:
+                    self.logger.info("connection to {0} {1} already exists. Skipped...".format(conn_id, self.destination))
+                self._mark_healthy(conn_id)
+            except Exception as e:
+                tb_str = traceback.format_exc()
+                self.logger.error("failed to start connection to {0} {1} ; {2} \n{3}".format(conn_id, self.destination, e.__class__.__name__, tb_str))
+                self._mark_unhealthy(conn_id)
+        if not self.healthy_conn_ids:
             self.got_disconnected = True
 
-    def stop(self):
+    def stop(self, flush_timeout=10):
         self.logger.debug("stop called")
         self.to_disconnect = True
-        self.conn.disconnect()
+        self._stop_writer(flush_timeout)
+        for conn_id, conn in self.connection_dict.items():
+            try:
+                conn.disconnect()
+            except Exception as e:
+                self.logger.warning("failed to disconnect from {0} ; {1}: {2}".format(conn_id, e.__class__.__name__, e))
+            self.logger.info("disconnect from {0} {1}".format(conn_id, self.destination))
+        with self.pool_lock:
+            self.healthy_conn_ids = []
         self.got_connected = False
-        self.logger.info("disconnect from {0} {1}".format(self.conn_id, self.destination))
 
     def restart(self):
         self.logger.debug("restart called")
         self.n_restart += 1
         self.logger.debug("the {0}th attempt to restart...".format(self.n_restart))
-        self.stop()
+        # messages in the outbound queue and a batch to retry are kept and written after reconnection
+        self.stop(flush_timeout=0)
         self._get_connection()
         self.go()
         self.logger.info("the {0}th restart done".format(self.n_restart))
@@ -1,13 +1,23 @@
+import concurrent.futures
 import json
+import multiprocessing
+import multiprocessing.util
 import os
 import re
 import time
+from concurrent.futures.process import BrokenProcessPool
 
 from pandacommon.pandalogger import logger_utils
 from pandacommon.pandautils.plugin_factory import PluginFactory
 from pandacommon.pandautils.thread_utils import GenericThread
 
-from .msg_bkr_utils import MBListenerProxy, MBSenderProxy, MsgBuffer
+from .msg_bkr_utils import (
+    MBListenerProxy,
+    MBSenderProxy,
+    MsgBatch,
+    MsgBuffer,
+    _get_backoff_delay,
+)
 
 # logger
 base_logger = logger_utils.setup_logger("msg_processor")
@@ -62,13 +72,73 @@ def get_mb_proxy(name, sconf, qconf, mode="listener", **kwargs):
         ack_mode=qconf.get("ack_mode", "client-individual"),
         max_buffer_len=qconf.get("max_buffer_len", 999),
         buffer_block_sec=qconf.get("buffer_block_sec", 10),
+        high_watermark=qconf.get("high_watermark"),
+        low_watermark=qconf.get("low_watermark"),
+        pause_on_high_watermark=qconf.get("pause_on_high_watermark", False),
         use_transaction=qconf.get("use_transaction", True),
+        async_send=qconf.get("async_send", False),
+        max_outbound_len=qconf.get("max_outbound_len", 10000),
+        receipt_window=qconf.get("receipt_window", 0),
+        max_retries=qconf.get("max_retries", 3),
+        receipt_timeout_sec=qconf.get("receipt_timeout_sec", 60),
+        conn_mode=qconf.get("conn_mode", "any" if mode == "sender" else "all"),
+        send_policy=qconf.get("send_policy", "round_robin"),
+        reconnect_base_sec=sconf.get("reconnect_base_sec", 1),
+        reconnect_max_sec=sconf.get("reconnect_max_sec", 300),
         verbose=sconf.get("verbose", False) or qconf.get("verbose", False),
         **kwargs
     )
     return mb_proxy
 
 
+# plugin instance in worker process of process executor
+_worker_plugin = None
+
+
+# initialize plugin in worker process
+def _init_worker_plugin(plugin_conf):
+    """
+    initializer of worker processes for process executor; instantiate and initialize the plugin once per process
+    """
+    global _worker_plugin
+    _worker_plugin = PluginFactory().get_plugin(plugin_conf)
+    _worker_plugin.initialize()
+    # terminate the plugin when the worker exits; atexit does not run in multiprocessing children
+    multiprocessing.util.Finalize(None, _terminate_worker_plugin, exitpriority=10)
+
+
+# terminate plugin in worker process
+def _terminate_worker_plugin():
+    global _worker_plugin
+    if _worker_plugin is not None:
+        _worker_plugin.terminate()
+        _worker_plugin = None
+
+
+# process a message in worker process
+def _process_in_worker(msg_obj):
+    """
+    run plugin.process in worker process; the returned value must be picklable
+    """
+    return _worker_plugin.process(msg_obj)
+
+
+# message object detached from mb proxy
+class DetachedMsgObj(object):
+    """
+    Picklable copy of message object without the associated proxy, passed to worker processes
+    """
+
+    __slots__ = ("conn_id", "sub_id", "msg_id", "ack_id", "data")
+
+    def __init__(self, msg_obj):
+        self.conn_id = msg_obj.conn_id
+        self.sub_id = msg_obj.sub_id
+        self.msg_id = msg_obj.msg_id
+        self.ack_id = msg_obj.ack_id
+        self.data = msg_obj.data
+
+
 # simple message processor plugin Base
 class SimpleMsgProcPluginBase:
     """
@@ -152,13 +222,56 @@ class MultiMsgProcPluginBase:
         return GenericThread().get_pid(current=True)
 
 
+# batch message processor plugin Base
+class BatchMsgProcPluginBase:
+    """
+    Base class of batch message processor plugin
+    Batch message processor receives messages from one queue in batches, e.g. for bulk insert into DB,
+    processes them, and optionally sends new messages to another queue
+    The messages of a batch are acknowledged in one transaction. If process_batch raises an exception,
+    the messages are processed again one by one to acknowledge good ones and reject bad ones individually
+    """
+
+    def __init__(self, **params):
+        """
+        Low level initialization called by plugin factory
+        The dict of params configured is passed to self.params
+        Do NOT overwrite __init__ for initialization. Instead, overwrite initialize(self) function
+        """
+        self.params = params
+
+    def initialize(self):
+        """
+        initialize plugin instance, run once before loop in thread
+        """
+
+    def terminate(self):
+        """
+        terminate plugin instance, run before stopping the thread
+        """
+
+    def process_batch(self, msg_obj_list):
+        """
+        process a batch of messages
+        Get the list of msg_obj from the incoming MQ
+        Returned iterable of values will be sent to the outgoing MQ (if any); None for nothing to send
+        """
+        raise NotImplementedError
+
+    def get_pid(self):
+        """
+        get generic pid, including hostname, os process id, thread id
+        """
+        return GenericThread().get_pid(current=True)
+
+
 # simple message processor thread
 class SimpleMsgProcThread(GenericThread):
     """
     Thread of simple message processor of certain plugin
     """
 
-    def __init__(self, plugin, attr_dict, sleep_time_min, sleep_time_max, thread_j):
+    def __init__(self, plugin, attr_dict, sleep_time_min, sleep_time_max, thread_j, wait_timeout=1):
         GenericThread.__init__(self)
         self.logger = logger_utils.make_logger(base_logger, token=self.get_pid(), method_name="SimpleMsgProcThread.__init__")
         self.__to_run = True
@@ -167,6 +280,8 @@ class SimpleMsgProcThread(GenericThread):
         self.mb_sender_proxy = attr_dict.get("mb_sender_proxy")
         self.sleep_time_min = sleep_time_min
         self.sleep_time_max = sleep_time_max
+        # max seconds to wait for a message before checking the stop signal
+        self.wait_timeout = wait_timeout
         self.thread_j = thread_j
         self.verbose = attr_dict.get("verbose", False)
 
@@ -188,8 +303,8 @@ class SimpleMsgProcThread(GenericThread):
             proc_ret = None
             # as consumer
             if self.in_queue:
-                # get from buffer
-                msg_obj = msg_buffer.get()
+                # get from buffer; wake up as soon as a message arrives
+                msg_obj = msg_buffer.get(timeout=self.wait_timeout)
                 if msg_obj is not None:
                     if self.verbose:
                         self.logger.debug("received a new message")
@@ -221,11 +336,12 @@ class SimpleMsgProcThread(GenericThread):
                 self.mb_sender_proxy.send(proc_ret)
                 if self.verbose:
                     self.logger.debug("sent a processed message")
-            # sleep
-            if is_processed:
-                time.sleep(self.sleep_time_min)
-            else:
-                time.sleep(self.sleep_time_max)
+            # sleep only as pure producer; consumer already waited on the buffer
+            if not self.in_queue:
+                if is_processed:
+                    time.sleep(self.sleep_time_min)
+                else:
+                    time.sleep(self.sleep_time_max)
         # stop loop
         self.logger.info("stopped loop")
         # tear down
@@ -337,18 +453,274 @@ class MultiMsgProcThread(GenericThread):
         self.__to_run = False
 
 
+# batch message processor thread
+class BatchMsgProcThread(GenericThread):
+    """
+    Thread of batch message processor of certain plugin
+    """
+
+    def __init__(self, plugin, attr_dict, thread_j, wait_timeout=1):
+        GenericThread.__init__(self)
+        self.logger = logger_utils.make_logger(base_logger, token=self.get_pid(), method_name="BatchMsgProcThread.__init__")
+        self.__to_run = True
+        self.plugin = plugin
+        self.in_queue = attr_dict.get("in_queue")
+        self.mb_listener_proxy = attr_dict.get("mb_listener_proxy")
+        self.mb_sender_proxy = attr_dict.get("mb_sender_proxy")
+        self.batch_size = attr_dict.get("batch_size", 100)
+        self.batch_linger_ms = attr_dict.get("batch_linger_ms", 0)
+        self.cumulative_ack = attr_dict.get("cumulative_ack", False)
+        self.thread_j = thread_j
+        # max seconds to wait for a message before checking the stop signal
+        self.wait_timeout = wait_timeout
+        self.verbose = attr_dict.get("verbose", False)
+        if self.mb_listener_proxy is None:
+            raise ValueError("batch message processor requires in_queue")
+
+    def _process_one_by_one(self, msg_batch):
+        """
+        process messages of a failed batch one by one; failed messages are NACKed and the others are ACKed
+        return list of values to send
+        """
+        proc_ret_list = []
+        retry_batch = MsgBatch(self.mb_listener_proxy, msg_batch.msg_obj_list, is_transacted=msg_batch.is_transacted)
+        try:
+            with retry_batch:
+                for msg_obj in retry_batch:
+                    try:
+                        proc_ret = self.plugin.process_batch([msg_obj])
+                        if proc_ret is not None:
+                            proc_ret_list.extend(proc_ret)
+                    except Exception as e:
+                        retry_batch.mark_failed(msg_obj)
+                        self.logger.error("error when process message msg_id={0} with {1}: {2} ".format(msg_obj.msg_id, e.__class__.__name__, e))
+        except Exception as e:
+            self.logger.error("failed to acknowledge {0} messages with {1}: {2} ; not to send results".format(len(retry_batch), e.__class__.__name__, e))
+            return []
+        return proc_ret_list
+
+    def run(self):
+        # update logger thread id
+        self.logger = logger_utils.make_logger(base_logger, token=self.get_pid(), method_name="BatchMsgProcThread")
+        # start
+        self.logger.info("start run")
+        # initialization step of plugin
+        self.logger.info("plugin initialize")
+        self.plugin.initialize()
+        self.logger.info("message buffer is {0} ; batch_size={1} batch_linger_ms={2}".format(self.in_queue, self.batch_size, self.batch_linger_ms))
+        # main loop
+        self.logger.info("start loop")
+        while self.__to_run:
+            # get a batch from buffer; wake up as soon as a message arrives and linger for more
+            msg_batch = self.mb_listener_proxy.get_msg_batch(
+                limit=self.batch_size, timeout=self.wait_timeout, linger_ms=self.batch_linger_ms, cumulative_ack=self.cumulative_ack
+            )
+            if not len(msg_batch):
+                continue
+            if self.verbose:
+                self.logger.debug("received a batch of {0} messages".format(len(msg_batch)))
+                self.logger.debug("plugin process start")
+            proc_ret_list = []
+            is_batch_failed = False
+            try:
+                with msg_batch as _msg_batch:
+                    try:
+                        proc_ret = self.plugin.process_batch(_msg_batch.msg_obj_list)
+                    except Exception:
+                        is_batch_failed = True
+                        raise
+                if proc_ret is not None:
+                    proc_ret_list = list(proc_ret)
+                if self.verbose:
+                    self.logger.debug("successfully processed")
+            except Exception as e:
+                if is_batch_failed:
+                    self.logger.error(
+                        "error when process a batch of {0} messages with {1}: {2} ; retry one by one".format(len(msg_batch), e.__class__.__name__, e)
+                    )
+                    proc_ret_list = self._process_one_by_one(msg_batch)
+                else:
+                    # begin or acknowledgement failed; the broker redelivers the messages, so neither retry nor send results
+                    self.logger.error("failed to acknowledge a batch of {0} messages with {1}: {2} ".format(len(msg_batch), e.__class__.__name__, e))
+            if self.verbose:
+                self.logger.debug("plugin process end")
+            # as producer
+            if self.mb_sender_proxy:
+                for proc_ret in proc_ret_list:
+                    self.mb_sender_proxy.send(proc_ret)
+                if self.verbose:
+                    self.logger.debug("sent {0} processed messages".format(len(proc_ret_list)))
+        # stop loop
+        self.logger.info("stopped loop")
+        # tear down
+        # terminate plugin
+        self.logger.info("plugin terminate")
+        self.plugin.terminate()
+        self.logger.info("stopped run")
+
+    def stop(self):
+        """
+        send stop signal to this thread; will stop after current loop done
+        """
+        self.logger.debug("stop method called")
+        self.__to_run = False
+
+
+# message processor thread with process executor
+class ProcessPoolMsgProcThread(GenericThread):
+    """
+    Thread of message processor running plugin.process in a pool of worker processes, for CPU-bound plugins
+    The plugin is instantiated and initialized in each worker process; ACK/NACK and sending stay in this thread
+    """
+
+    def __init__(self, plugin, attr_dict, thread_j, wait_timeout=1):
+        GenericThread.__init__(self)
+        self.logger = logger_utils.make_logger(base_logger, token=self.get_pid(), method_name="ProcessPoolMsgProcThread.__init__")
+        self.__to_run = True
+        self.plugin = plugin
+        self.plugin_conf = attr_dict.get("plugin_conf")
+        self.in_queue = attr_dict.get("in_queue")
+        self.mb_listener_proxy = attr_dict.get("mb_listener_proxy")
+        self.mb_sender_proxy = attr_dict.get("mb_sender_proxy")
+        # number of worker processes
+        self.n_workers = attr_dict.get("n_threads", 1)
+        # start method of worker processes
+        self.mp_start_method = attr_dict.get("mp_start_method", "spawn")
+        # max seconds to wait for results of messages taken at once; the pool is recreated if a worker hangs
+        self.process_timeout = attr_dict.get("process_timeout", 600)
+        self.thread_j = thread_j
+        # max seconds to wait for a message before checking the stop signal
+        self.wait_timeout = wait_timeout
+        self.verbose = attr_dict.get("verbose", False)
+        if self.mb_listener_proxy is None:
+            raise ValueError("process executor requires in_queue")
+        if isinstance(plugin, (MultiMsgProcPluginBase, BatchMsgProcPluginBase)):
+            raise ValueError("process executor supports only simple message processor plugins")
+
+    def _make_executor(self):
+        """
+        make a pool of worker processes where the plugin is initialized
+        """
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.n_workers,
+            mp_context=multiprocessing.get_context(self.mp_start_method),
+            initializer=_init_worker_plugin,
+            initargs=(self.plugin_conf,),
+        )
+
+    def _kill_executor(self, executor):
+        """
+        shut down a pool whose workers may hang, terminating them instead of waiting
+        """
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            try:
+                process.terminate()
+            except Exception:
+                pass
+        executor.shutdown(wait=True)
+
+    def _sleep(self, duration):
+        """
+        sleep for duration seconds unless stopped
+        """
+        end_time = time.monotonic() + duration
+        while self.__to_run and time.monotonic() < end_time:
+            time.sleep(min(self.wait_timeout, end_time - time.monotonic(), 1))
+
+    def run(self):
+        # update logger thread id
+        self.logger = logger_utils.make_logger(base_logger, token=self.get_pid(), method_name="ProcessPoolMsgProcThread")
+        # start
+        self.logger.info("start run")
+        # worker pool where the plugin is initialized
+        self.logger.info("start {0} worker processes with {1}".format(self.n_workers, self.mp_start_method))
+        executor = self._make_executor()
+        # number of consecutive times the pool got broken
+        n_broken = 0
+        self.logger.info("message buffer is {0}".format(self.in_queue))
+        # main loop
+        self.logger.info("start loop")
+        while self.__to_run:
+            # get messages from buffer; wake up as soon as a message arrives
+            msg_obj_list = self.mb_listener_proxy.get_messages(limit=self.n_workers * 2, timeout=self.wait_timeout)
+            if not msg_obj_list:
+                continue
+            # submit to workers
+            future_list = []
+            for msg_obj in msg_obj_list:
+                try:
+                    future = executor.submit(_process_in_worker, DetachedMsgObj(msg_obj))
+                except BrokenProcessPool as e:
+                    future = concurrent.futures.Future()
+                    future.set_exception(e)
+                future_list.append(future)
+            # acknowledge in order when results come back
+            deadline = time.monotonic() + self.process_timeout
+            is_broken = False
+            is_hung = False
+            for msg_obj, future in zip(msg_obj_list, future_list):
+                is_processed = False
+                proc_ret = None
+                try:
+                    with msg_obj:
+                        proc_ret = future.result(timeout=max(deadline - time.monotonic(), 0))
+                    is_processed = True
+                    n_broken = 0
+                    if self.verbose:
+                        self.logger.debug("successfully processed msg_id={0}".format(msg_obj.msg_id))
+                except BrokenProcessPool as e:
+                    is_broken = True
+                    self.logger.error("worker pool broken when process message msg_id={0} with {1}: {2} ".format(msg_obj.msg_id, e.__class__.__name__, e))
+                except concurrent.futures.TimeoutError:
+                    is_hung = True
+                    self.logger.error("message msg_id={0} not processed in {1} sec".format(msg_obj.msg_id, self.process_timeout))
+                except Exception as e:
+                    self.logger.error("error when process message msg_id={0} with {1}: {2} ".format(msg_obj.msg_id, e.__class__.__name__, e))
+                # as producer
+                if self.mb_sender_proxy and is_processed:
+                    self.mb_sender_proxy.send(proc_ret)
+                    if self.verbose:
+                        self.logger.debug("sent a processed message")
+            # recreate the pool when a worker died, hung, or the plugin failed to initialize
+            if is_broken or is_hung:
+                n_broken += 1
+                delay = _get_backoff_delay(n_broken, 1, 60)
+                self.logger.error("worker pool is broken or hung {0} times in a row ; recreate it in {1:.1f} sec".format(n_broken, delay))
+                if is_hung:
+                    self._kill_executor(executor)
+                else:
+                    executor.shutdown(wait=True)
+                self._sleep(delay)
+                executor = self._make_executor()
+                self.logger.info("recreated {0} worker processes".format(self.n_workers))
+        # stop loop
+        self.logger.info("stopped loop")
+        # tear down
+        self.logger.info("shut down worker processes")
+        executor.shutdown(wait=True)
+        self.logger.info("stopped run")
+
+    def stop(self):
+        """
+        send stop signal to this thread; will stop after current loop done
+        """
+        self.logger.debug("stop method called")
+        self.__to_run = False
+
+
 # message processing agent base
 class MsgProcAgentBase(GenericThread):
     """
     Base class of message processing agent (main thread)
     """
 
-    def __init__(self, config_file, process_sleep_time_min=0.0001, process_sleep_time_max=0.005, **kwargs):
+    def __init__(self, config_file, process_sleep_time_min=0.0001, process_sleep_time_max=0.005, process_wait_timeout=1, **kwargs):
         GenericThread.__init__(self)
         self.__to_run = True
         self.config_file = config_file
         self.process_sleep_time_min = process_sleep_time_min
         self.process_sleep_time_max = process_sleep_time_max
+        self.process_wait_timeout = process_wait_timeout
         self.init_mb_listener_proxy_list = []
         self.init_mb_sender_proxy_list = []
         self.init_processor_list = []
@@ -402,6 +774,20 @@ class MsgProcAgentBase(GenericThread):
                     'in_queue': 'Queue_1',
                     'out_queue': 'Queue_2',
                 },
+                'Processor_2': {
+                    'module': 'plugin.module',
+                    'name': 'BatchPluginClassName',
+                    'in_queue': 'Queue_3',
+                    'batch_size': 100,
+                    'batch_linger_ms': 200,
+                },
+                'Processor_3': {
+                    'module': 'plugin.module',
+                    'name': 'CpuBoundPluginClassName',
+                    'n_threads': 4,
+                    'executor': 'process',
+                    'in_queue': 'Queue_4',
+                },
                 ...
             }
         """
@@ -442,12 +828,15 @@ class MsgProcAgentBase(GenericThread):
                 in_q_set.add(in_queue)
             if out_queue:
                 out_q_set.add(out_queue)
-            # n_threads of processors
+            # n_threads of processors; number of worker processes with process executor
             n_threads = pconf.get("n_threads", 1)
-            # plugin: one instance for each thread
+            # executor: thread or process
+            executor = pconf.get("executor", "thread")
+            # plugin: one instance for each thread; only one thread with process executor
+            n_instances = 1 if executor == "process" else n_threads
             plugin_factory = PluginFactory()
             plugin_class_name = None
-            for thread_j in range(n_threads):
+            for thread_j in range(n_instances):
                 processor_id = (proc, thread_j)
                 plugin = plugin_factory.get_plugin(pconf)
                 self.processor_instance_map[processor_id] = plugin
@@ -456,9 +845,19 @@ class MsgProcAgentBase(GenericThread):
             # fill in thread attribute dict
             processor_attr_map[proc] = {}
             processor_attr_map[proc]["n_threads"] = n_threads
+            processor_attr_map[proc]["n_instances"] = n_instances
+            processor_attr_map[proc]["executor"] = executor
+            if executor == "process":
+                processor_attr_map[proc]["plugin_conf"] = dict(pconf)
+                processor_attr_map[proc]["mp_start_method"] = pconf.get("mp_start_method", "spawn")
+                processor_attr_map[proc]["process_timeout"] = pconf.get("process_timeout", 600)
             processor_attr_map[proc]["in_queue"] = in_queue
             processor_attr_map[proc]["out_queue"] = out_queue
             processor_attr_map[proc]["plugin_class_name"] = plugin_class_name
+            # batch parameters for batch processors
+            for key in ["batch_size", "batch_linger_ms", "cumulative_ack"]:
+                if key in pconf:
+                    processor_attr_map[proc][key] = pconf[key]
         # mb_listener_proxy instances
         mb_listener_proxy_dict = {}
         for in_queue in in_q_set:
@@ -488,8 +887,8 @@ class MsgProcAgentBase(GenericThread):
         # fill processor list
         self.init_processor_list = []
         for processor_name, attr_dict in processor_attr_map.items():
-            n_threads = attr_dict["n_threads"]
-            for thread_j in range(n_threads):
+            n_instances = attr_dict["n_instances"]
+            for thread_j in range(n_instances):
                 processor_id = (processor_name, thread_j)
                 self.init_processor_list.append(processor_id)
         # set self attributes
@@ -519,6 +918,16 @@ class MsgProcAgentBase(GenericThread):
         tmp_logger.debug("start")
         for mb_proxy in mb_listener_proxy_list:
             if mb_proxy.got_disconnected and not mb_proxy.to_disconnect:
+                if mb_proxy.has_healthy_connections():
+                    # reconnect only failed connections while the others keep delivering
+                    n_failed = mb_proxy.reconnect_failed()
+                    if n_failed:
+                        tmp_logger.debug(
+                            "listener {0} has {1} connections still failed ; states: {2}".format(mb_proxy.name, n_failed, mb_proxy.get_connection_states())
+                        )
+                    else:
+                        tmp_logger.info("reconnected failed connections of listener {0}".format(mb_proxy.name))
+                    continue
                 tmp_logger.debug("found listener {0} disconnected unexpectedly; trigger restart...".format(mb_proxy.name))
                 mb_proxy.restart()
                 if mb_proxy.n_restart > 10:
@@ -585,9 +994,21 @@ class MsgProcAgentBase(GenericThread):
                 processor_name, thread_j = processor_id
                 attr_dict = self.processor_attr_map[processor_name]
                 plugin = self.processor_instance_map[processor_id]
-                self.processor_thread_map[processor_id] = SimpleMsgProcThread(
-                    plugin, attr_dict, sleep_time_min=self.process_sleep_time_min, sleep_time_max=self.process_sleep_time_max, thread_j=thread_j
-                )
+                if attr_dict["executor"] == "process":
+                    self.processor_thread_map[processor_id] = ProcessPoolMsgProcThread(
+                        plugin, attr_dict, thread_j=thread_j, wait_timeout=self.process_wait_timeout
+                    )
+                elif isinstance(plugin, BatchMsgProcPluginBase):
+                    self.processor_thread_map[processor_id] = BatchMsgProcThread(plugin, attr_dict, thread_j=thread_j, wait_timeout=self.process_wait_timeout)
+                else:
+                    self.processor_thread_map[processor_id] = SimpleMsgProcThread(
+                        plugin,
+                        attr_dict,
+                        sleep_time_min=self.process_sleep_time_min,
+                        sleep_time_max=self.process_sleep_time_max,
+                        thread_j=thread_j,
+                        wait_timeout=self.process_wait_timeout,
+                    )
                 mc_thread = self.processor_thread_map[processor_id]
                 mc_thread.start()
                 tmp_logger.info(
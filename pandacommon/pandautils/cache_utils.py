@@ -0,0 +1,206 @@
+import collections
+import threading
+import time
+
+
+# placeholder for a value being loaded by another thread
+class _Loading(object):
+    __slots__ = ("event", "value", "error", "is_loaded")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.is_loaded = False
+
+
+# cache with expiry and LRU eviction
+class TTLCache(object):
+    """
+    Thread-safe cache where entries expire after ttl seconds on the monotonic clock,
+    and the least recently used entries are evicted beyond max_size.
+    Keys are spread over shards with their own locks so that concurrent threads rarely contend.
+    LRU order is kept per shard; when the cache is full, a shard evicts its own least recently used entries,
+    or those of other shards if it has no other entry. max_size can be exceeded momentarily by concurrent sets
+    """
+
+    def __init__(self, max_size=10000, ttl=600, n_shards=16):
+        # max number of entries
+        self.max_size = max_size
+        # default time to live in seconds
+        self.ttl = ttl
+        # shards of {key: (expiry, value)} in LRU order, their locks, and values being loaded; no more shards than max_size
+        n_shards = max(min(n_shards, max_size), 1)
+        self.n_shards = n_shards
+        self.shards = [collections.OrderedDict() for i in range(n_shards)]
+        self.locks = [threading.Lock() for i in range(n_shards)]
+        self.loading = [{} for i in range(n_shards)]
+        # statistics per shard
+        self.stats = [collections.Counter() for i in range(n_shards)]
+
+    def _get_shard_index(self, key):
+        return hash(key) % self.n_shards
+
+    def _get_fresh(self, i_shard, key, time_now):
+        """
+        get (is_found, value) of a fresh entry updating LRU order, with the shard lock held
+        """
+        shard = self.shards[i_shard]
+        entry = shard.get(key)
+        if entry is None:
+            self.stats[i_shard]["misses"] += 1
+            return False, None
+        if entry[0] <= time_now:
+            del shard[key]
+            self.stats[i_shard]["misses"] += 1
+            self.stats[i_shard]["expirations"] += 1
+            return False, None
+        shard.move_to_end(key)
+        self.stats[i_shard]["hits"] += 1
+        return True, entry[1]
+
+    def _set(self, i_shard, key, value, ttl, time_now):
+        """
+        set an entry evicting least recently used ones of the shard while the cache is full, with the shard lock held
+        """
+        shard = self.shards[i_shard]
+        shard[key] = (time_now + (self.ttl if ttl is None else ttl), value)
+        shard.move_to_end(key)
+        while len(shard) > 1 and len(self) > self.max_size:
+            shard.popitem(last=False)
+            self.stats[i_shard]["evictions"] += 1
+
+    def _evict_others(self, i_shard):
+        """
+        evict least recently used entries of other shards while the cache is full, taking one shard lock at a time
+        """
+        for i in range(1, self.n_shards):
+            if len(self) <= self.max_size:
+                return
+            j_shard = (i_shard + i) % self.n_shards
+            with self.locks[j_shard]:
+                shard = self.shards[j_shard]
+                while shard and len(self) > self.max_size:
+                    shard.popitem(last=False)
+                    self.stats[j_shard]["evictions"] += 1
+
+    def get(self, key, default=None):
+        i_shard = self._get_shard_index(key)
+        with self.locks[i_shard]:
+            is_found, value = self._get_fresh(i_shard, key, time.monotonic())
+        return value if is_found else default
+
+    def set(self, key, value, ttl=None):
+        i_shard = self._get_shard_index(key)
+        with self.locks[i_shard]:
+            self._set(i_shard, key, value, ttl, time.monotonic())
+        if len(self) > self.max_size:
+            self._evict_others(i_shard)
+
+    def delete(self, key):
+        i_shard = self._get_shard_index(key)
+        with self.locks[i_shard]:
+            self.shards[i_shard].pop(key, None)
+
+    def __getitem__(self, key):
+        i_shard = self._get_shard_index(key)
+        with self.locks[i_shard]:
+            is_found, value = self._get_fresh(i_shard, key, time.monotonic())
+        if not is_found:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.delete(key)
+
+    # check if a fresh entry exists without updating LRU order and statistics
+    def __contains__(self, key):
+        i_shard = self._get_shard_index(key)
+        with self.locks[i_shard]:
+            entry = self.shards[i_shard].get(key)
+            return entry is not None and entry[0] > time.monotonic()
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def get_or_compute(self, key, loader, ttl=None):
+        """
+        get the value of the key, calling loader() to compute it on a miss.
+        Concurrent misses of the same key wait for a single call of loader; its exception is raised to all of them
+        and nothing is cached. If loader is interrupted by BaseException, the waiting threads try again
+        """
+        i_shard = self._get_shard_index(key)
+        with self.locks[i_shard]:
+            is_found, value = self._get_fresh(i_shard, key, time.monotonic())
+            if is_found:
+                return value
+            loading = self.loading[i_shard].get(key)
+            is_leader = loading is None
+            if is_leader:
+                loading = _Loading()
+                self.loading[i_shard][key] = loading
+            else:
+                self.stats[i_shard]["collapsed"] += 1
+        if not is_leader:
+            loading.event.wait()
+            if loading.error is not None:
+                raise loading.error
+            if not loading.is_loaded:
+                return self.get_or_compute(key, loader, ttl)
+            return loading.value
+        try:
+            loading.value = loader()
+            loading.is_loaded = True
+        except Exception as e:
+            loading.error = e
+            raise
+        finally:
+            # always clear the placeholder and wake up waiters
+            with self.locks[i_shard]:
+                if loading.is_loaded:
+                    self.stats[i_shard]["loads"] += 1
+                    self._set(i_shard, key, loading.value, ttl, time.monotonic())
+                else:
+                    self.stats[i_shard]["load_errors"] += 1
+                del self.loading[i_shard][key]
+            loading.event.set()
+        if len(self) > self.max_size:
+            self._evict_others(i_shard)
+        return loading.value
+
+    def purge_expired(self):
+        """
+        delete expired entries
+        return number of deleted entries
+        """
+        n_deleted = 0
+        for i_shard in range(self.n_shards):
+            with self.locks[i_shard]:
+                time_now = time.monotonic()
+                shard = self.shards[i_shard]
+                expired_keys = [key for key, entry in shard.items() if entry[0] <= time_now]
+                for key in expired_keys:
+                    del shard[key]
+                self.stats[i_shard]["expirations"] += len(expired_keys)
+                n_deleted += len(expired_keys)
+        return n_deleted
+
+    def clear(self):
+        for i_shard in range(self.n_shards):
+            with self.locks[i_shard]:
+                self.shards[i_shard].clear()
+
+    def get_stats(self):
+        """
+        get statistics of hits, misses, evictions, expirations, loads, load_errors, collapsed misses, and size
+        """
+        total = collections.Counter()
+        for i_shard in range(self.n_shards):
+            with self.locks[i_shard]:
+                total.update(self.stats[i_shard])
+        ret = {name: total[name] for name in ("hits", "misses", "evictions", "expirations", "loads", "load_errors", "collapsed")}
+        ret["size"] = len(self)
+        return ret
@@ -12,10 +12,10 @@ try:
 except ImportError:
     from urlparse import urlparse
 
-from .thread_utils import MapWithLockAndTimeout
+from .cache_utils import TTLCache
 
 # DNS cache
-dnsMap = MapWithLockAndTimeout()
+dnsMap = TTLCache(max_size=1000, ttl=10 * 60)
 
 
 # HTTP adaptor with randomized DNS resolution
@@ -75,14 +75,14 @@ def resolve_host_in_url(url: str) -> list[str]:
             port = 80
         else:
             port = 443
-    # check record
-    if parsed.hostname in dnsMap:
-        dns_records = dnsMap[parsed.hostname]
-    else:
+
+    # resolve only once for concurrent lookups of the same host
+    def _resolve():
         family = allowed_gai_family()
-        dns_records = socket.getaddrinfo(host, port, family, socket.SOCK_STREAM)
-        dns_records = list(set([socket.getfqdn(record[4][0]) for record in dns_records]))
-        dnsMap[parsed.hostname] = dns_records
+        records = socket.getaddrinfo(host, port, family, socket.SOCK_STREAM)
+        return list(set([socket.getfqdn(record[4][0]) for record in records]))
+
+    dns_records = dnsMap.get_or_compute(parsed.hostname, _resolve)
     return copy.copy(dns_records)
 
 
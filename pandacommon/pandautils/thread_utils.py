@@ -1,9 +1,15 @@
+import bisect
+import contextlib
+import ctypes
 import datetime
+import hashlib
 import multiprocessing
 import os
+import pickle
 import random
 import socket
 import threading
+import time
 
 
 class GenericThread(threading.Thread):
@@ -129,39 +135,469 @@ class WeightedLists(object):
             return d
 
 
+# Fenwick tree (binary indexed tree) helpers over a 1-based array tree[0..n] of sums, usable with lists and shared arrays
+def fenwick_add(tree, n, index, delta):
+    """
+    add delta to the weight at 0-based index
+    """
+    i = index + 1
+    while i <= n:
+        tree[i] += delta
+        i += i & -i
+
+
+def fenwick_prefix_sum(tree, index):
+    """
+    get sum of weights at 0-based indices [0, index)
+    """
+    total = 0
+    i = index
+    while i > 0:
+        total += tree[i]
+        i -= i & -i
+    return total
+
+
+def fenwick_append(tree, weight):
+    """
+    append a weight to a growable 1-based tree list
+    """
+    i = len(tree)
+    tree.append(weight + fenwick_prefix_sum(tree, i - 1) - fenwick_prefix_sum(tree, i - (i & -i)))
+
+
+def fenwick_build(weights):
+    """
+    build a 1-based tree list from weights in O(n)
+    """
+    n = len(weights)
+    tree = [0] + list(weights)
+    for i in range(1, n + 1):
+        j = i + (i & -i)
+        if j <= n:
+            tree[j] += tree[i]
+    return tree
+
+
+def fenwick_find(tree, n, value):
+    """
+    get the smallest 0-based index whose prefix sum including itself exceeds value
+    """
+    pos = 0
+    step = 1 << (n.bit_length() - 1) if n > 0 else 0
+    while step:
+        next_pos = pos + step
+        if next_pos <= n and tree[next_pos] <= value:
+            pos = next_pos
+            value -= tree[next_pos]
+        step >>= 1
+    return pos
+
+
+# weighted lists in a process with O(log k) weighted choice over k lists
+class LocalWeightedLists(object):
+    """
+    Weighted lists used by threads in a process, with the same API as WeightedLists plus pop_many.
+    Weights are kept in a Fenwick tree; exhausted lists are dropped from the tree in O(log k)
+    and their slots are compacted once they are the majority
+    """
+
+    def __init__(self, lock=None):
+        self.lock = threading.Lock()
+        # lists, weights, and Fenwick tree over weights, sharing indices
+        self.data = []
+        self.weights = []
+        self.tree = [0]
+        # number of remaining items and non-empty lists
+        self.n_remaining = 0
+        self.n_active = 0
+
+    def __len__(self):
+        return self.n_remaining
+
+    def add(self, weight, list_data):
+        if not list_data or weight <= 0:
+            return
+        with self.lock:
+            self.data.append(list(list_data))
+            self.weights.append(weight)
+            fenwick_append(self.tree, weight)
+            self.n_remaining += len(list_data)
+            self.n_active += 1
+
+    def _compact(self):
+        """
+        drop exhausted lists and rebuild the tree, with the lock held
+        """
+        live = [i for i in range(len(self.data)) if self.data[i]]
+        self.data = [self.data[i] for i in live]
+        self.weights = [self.weights[i] for i in live]
+        self.tree = fenwick_build(self.weights)
+
+    def _pop_one(self):
+        """
+        pop an item from a list chosen with probability proportional to its weight, with the lock held
+        """
+        n_lists = len(self.data)
+        total = fenwick_prefix_sum(self.tree, n_lists)
+        item = fenwick_find(self.tree, n_lists, random.random() * total)
+        if item >= n_lists or not self.data[item]:
+            # rounding errors of float sums; fall back to linear scan
+            candidates = [i for i in range(n_lists) if self.data[i]]
+            item = random.choices(candidates, weights=[self.weights[i] for i in candidates])[0]
+        d = self.data[item].pop()
+        self.n_remaining -= 1
+        # delete empty
+        if not self.data[item]:
+            fenwick_add(self.tree, n_lists, item, -self.weights[item])
+            self.weights[item] = 0
+            self.n_active -= 1
+            if self.n_active * 2 < len(self.data):
+                self._compact()
+        return d
+
+    def pop(self):
+        with self.lock:
+            if self.n_remaining <= 0:
+                return None
+            return self._pop_one()
+
+    def pop_many(self, n):
+        """
+        pop up to n items with one lock acquisition
+        """
+        with self.lock:
+            return [self._pop_one() for i in range(min(n, self.n_remaining))]
+
+
+# weighted lists in shared memory, without pickling all lists on each access
+class SharedWeightedLists(object):
+    """
+    Weighted lists shared among processes forked after creation, with the same API as WeightedLists.
+    Weights are kept in a Fenwick tree for O(log n) weighted choice. Items are pickled into a byte heap
+    with per-item offsets, and each list is a range of items popped from the end.
+    Capacities are fixed at creation and bound the lists and items alive at the same time:
+    slots of exhausted lists are reused, and the heap is compacted when it runs out of space for popped items
+    """
+
+    def __init__(self, lock=None, max_lists=10000, max_items=100000, max_bytes=8 * 1024 * 1024):
+        self.lock = multiprocessing.Lock()
+        self.max_lists = max_lists
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        # Fenwick tree and raw values of weights per list
+        self.tree = multiprocessing.RawArray(ctypes.c_double, max_lists + 1)
+        self.weights = multiprocessing.RawArray(ctypes.c_double, max_lists)
+        # index of the first item and number of remaining items per list
+        self.starts = multiprocessing.RawArray(ctypes.c_longlong, max_lists)
+        self.counts = multiprocessing.RawArray(ctypes.c_longlong, max_lists)
+        # stack of slots of exhausted lists to be reused
+        self.free_slots = multiprocessing.RawArray(ctypes.c_longlong, max_lists)
+        # offsets of pickled items in the heap, with one extra at the end
+        self.offsets = multiprocessing.RawArray(ctypes.c_longlong, max_items + 1)
+        self.heap = multiprocessing.RawArray(ctypes.c_char, max_bytes)
+        # number of used list slots, used items, used bytes, remaining items, free list slots
+        self.header = multiprocessing.RawArray(ctypes.c_longlong, 5)
+
+    def __len__(self):
+        with self.lock:
+            return self.header[3]
+
+    def _reset(self):
+        """
+        reclaim all space once lists are exhausted, with the lock held
+        """
+        ctypes.memset(self.tree, 0, ctypes.sizeof(self.tree))
+        ctypes.memset(self.weights, 0, ctypes.sizeof(self.weights))
+        for i in range(5):
+            self.header[i] = 0
+
+    def _rebuild_tree(self):
+        """
+        rebuild the Fenwick tree from weights to clear rounding errors of float sums, with the lock held
+        """
+        self.tree[:] = fenwick_build(self.weights[:])
+
+    def _compact(self):
+        """
+        move remaining items of lists to the front of the heap to reclaim space of popped items, with the lock held
+        """
+        heap_address = ctypes.addressof(self.heap)
+        live = sorted((self.starts[i], i) for i in range(self.header[0]) if self.counts[i] > 0)
+        n_items = 0
+        n_used_bytes = 0
+        for start, item in live:
+            count = self.counts[item]
+            begin = self.offsets[start]
+            end = self.offsets[start + count]
+            if begin != n_used_bytes:
+                ctypes.memmove(heap_address + n_used_bytes, heap_address + begin, end - begin)
+            shift = begin - n_used_bytes
+            self.offsets[n_items : n_items + count] = [offset - shift for offset in self.offsets[start : start + count]]
+            self.starts[item] = n_items
+            n_items += count
+            n_used_bytes += end - begin
+        self.offsets[n_items] = n_used_bytes
+        self.header[1] = n_items
+        self.header[2] = n_used_bytes
+        self._rebuild_tree()
+
+    def add(self, weight, list_data):
+        if not list_data or weight <= 0:
+            return
+        pickled_list = [pickle.dumps(d) for d in list_data]
+        n_bytes = sum(len(d) for d in pickled_list)
+        with self.lock:
+            if self.header[1] + len(pickled_list) > self.max_items or self.header[2] + n_bytes > self.max_bytes:
+                self._compact()
+            n_lists, n_items, n_used_bytes, n_remaining, n_free = self.header[:]
+            if n_items + len(pickled_list) > self.max_items or n_used_bytes + n_bytes > self.max_bytes or (n_free == 0 and n_lists >= self.max_lists):
+                raise ValueError("capacity of SharedWeightedLists exceeded")
+            if n_free > 0:
+                # reuse the slot of an exhausted list
+                item = self.free_slots[n_free - 1]
+                self.header[4] = n_free - 1
+            else:
+                item = n_lists
+                self.header[0] = n_lists + 1
+            self.starts[item] = n_items
+            self.counts[item] = len(pickled_list)
+            for d in pickled_list:
+                self.offsets[n_items] = n_used_bytes
+                self.heap[n_used_bytes : n_used_bytes + len(d)] = d
+                n_items += 1
+                n_used_bytes += len(d)
+            self.offsets[n_items] = n_used_bytes
+            self.weights[item] = weight
+            fenwick_add(self.tree, self.max_lists, item, weight)
+            self.header[1] = n_items
+            self.header[2] = n_used_bytes
+            self.header[3] = n_remaining + len(pickled_list)
+
+    def _choose(self):
+        """
+        choose a non-empty list with probability proportional to its weight, with the lock held
+        """
+        n_lists = self.header[0]
+        total = fenwick_prefix_sum(self.tree, n_lists)
+        item = fenwick_find(self.tree, self.max_lists, random.random() * total)
+        if item < n_lists and self.counts[item] > 0:
+            return item
+        # rounding errors of float sums; fall back to linear scan and clear the errors
+        self._rebuild_tree()
+        candidates = [i for i in range(n_lists) if self.counts[i] > 0]
+        return random.choices(candidates, weights=[self.weights[i] for i in candidates])[0]
+
+    def pop(self):
+        with self.lock:
+            if self.header[3] <= 0:
+                return None
+            item = self._choose()
+            self.counts[item] -= 1
+            index = self.starts[item] + self.counts[item]
+            d = pickle.loads(self.heap[self.offsets[index] : self.offsets[index + 1]])
+            self.header[3] -= 1
+            # delete empty and free its slot
+            if self.counts[item] == 0:
+                fenwick_add(self.tree, self.max_lists, item, -self.weights[item])
+                self.weights[item] = 0
+                self.free_slots[self.header[4]] = item
+                self.header[4] += 1
+            if self.header[3] == 0:
+                self._reset()
+            return d
+
+
+# stable 64-bit hash of a key, identical across processes unlike hash()
+def stable_key_hash(key):
+    digest = hashlib.blake2b(repr(key).encode("utf-8"), digest_size=8).digest()
+    # 0 is reserved for empty slots
+    return int.from_bytes(digest, "little") or 1
+
+
 # lock pool
 class LockPool(object):
+    """
+    Pool of locks shared among processes forked after creation, handing out a distinct lock per key in use.
+    Keys are tracked by their stable hashes in a shared open-addressing table together with lock indices
+    and reference counts, and free locks are kept in a shared stack, so that get and release are O(1)
+    without a manager process
+    """
+
     def __init__(self, pool_size=100):
         self.pool_size = pool_size
         self.lock = multiprocessing.Lock()
-        self.manager = multiprocessing.Manager()
-        self.key_to_lock = self.manager.dict()
-        self.lock_ref_count = self.manager.dict()
         self.lock_pool = {i: multiprocessing.Lock() for i in range(pool_size)}
+        # hash table with linear probing, at most half full
+        self.table_size = 1 << (2 * pool_size - 1).bit_length()
+        self.table_hashes = multiprocessing.RawArray(ctypes.c_ulonglong, self.table_size)
+        self.table_indices = multiprocessing.RawArray(ctypes.c_int, self.table_size)
+        self.lock_ref_count = multiprocessing.RawArray(ctypes.c_int, pool_size)
+        # stack of free lock indices and its size
+        self.free_indices = multiprocessing.RawArray(ctypes.c_int, list(range(pool_size)))
+        self.n_free = multiprocessing.RawValue(ctypes.c_int, pool_size)
+        # condition to wait for a free lock
+        self.cond = multiprocessing.Condition(self.lock)
+        # upper bounds in seconds of buckets for wait time histograms
+        self.wait_buckets = (0.001, 0.01, 0.1, 1, 10)
+        # per-lock counters of acquisitions, wait time histograms, and max number of holders and waiters
+        self.stripe_acquisitions = multiprocessing.RawArray(ctypes.c_longlong, pool_size)
+        self.stripe_wait_histogram = multiprocessing.RawArray(ctypes.c_longlong, pool_size * (len(self.wait_buckets) + 1))
+        self.stripe_max_holders = multiprocessing.RawArray(ctypes.c_int, pool_size)
+        # per-key counters in the process
+        self.key_stats_lock = threading.Lock()
+        self.key_stats = {}
+        self.max_tracked_keys = 10000
+
+    def _find_slot(self, key_hash):
+        """
+        get the slot of the key hash or the empty slot to insert it, with the lock held
+        """
+        mask = self.table_size - 1
+        slot = key_hash & mask
+        while self.table_hashes[slot] != 0 and self.table_hashes[slot] != key_hash:
+            slot = (slot + 1) & mask
+        return slot
+
+    def _delete_slot(self, slot):
+        """
+        delete a slot, shifting back following entries of the same probe sequence, with the lock held
+        """
+        mask = self.table_size - 1
+        self.table_hashes[slot] = 0
+        next_slot = (slot + 1) & mask
+        while self.table_hashes[next_slot] != 0:
+            key_hash = self.table_hashes[next_slot]
+            home = key_hash & mask
+            # move back if the empty slot is between home and the current slot in the probe sequence
+            if (next_slot - home) & mask >= (next_slot - slot) & mask:
+                self.table_hashes[slot] = key_hash
+                self.table_indices[slot] = self.table_indices[next_slot]
+                self.table_hashes[next_slot] = 0
+                slot = next_slot
+            next_slot = (next_slot + 1) & mask
+
+    def _get_index(self, key):
+        """
+        get index of the lock assigned to the key, assigning a free one if needed, with the lock held
+        return (index, number of holders) or (None, 0) when the pool is exhausted
+        """
+        key_hash = stable_key_hash(key)
+        slot = self._find_slot(key_hash)
+        if self.table_hashes[slot] == 0:
+            if self.n_free.value <= 0:
+                return None, 0
+            self.n_free.value -= 1
+            index = self.free_indices[self.n_free.value]
+            self.table_hashes[slot] = key_hash
+            self.table_indices[slot] = index
+            self.lock_ref_count[index] = 1
+        else:
+            index = self.table_indices[slot]
+            self.lock_ref_count[index] += 1
+        return index, self.lock_ref_count[index]
 
     def get(self, key):
         with self.lock:
-            if key not in self.key_to_lock:
-                in_used = set(self.key_to_lock.values())
-                free_locks = set(range(self.pool_size)).difference(in_used)
-                if not free_locks:
-                    return None
-                index = free_locks.pop()
-                self.key_to_lock[key] = index
-                self.lock_ref_count[index] = 1
-            else:
-                index = self.key_to_lock[key]
-                self.lock_ref_count[index] += 1
+            index, n_holders = self._get_index(key)
+            if index is None:
+                return None
             return self.lock_pool[index]
 
     def release(self, key):
+        key_hash = stable_key_hash(key)
         with self.lock:
-            if key not in self.key_to_lock:
+            slot = self._find_slot(key_hash)
+            if self.table_hashes[slot] == 0:
                 return
-            index = self.key_to_lock[key]
+            index = self.table_indices[slot]
             count = self.lock_ref_count[index]
             count -= 1
             if count <= 0:
                 count = 0
-                del self.key_to_lock[key]
+                self._delete_slot(slot)
+                self.free_indices[self.n_free.value] = index
+                self.n_free.value += 1
+                # wake up waiters for a free lock
+                self.cond.notify_all()
             self.lock_ref_count[index] = count
+
+    def _record_stats(self, key, index, n_holders, wait_time):
+        """
+        record an acquisition in per-lock counters in shared memory and per-key counters in the process
+        """
+        bucket = bisect.bisect_left(self.wait_buckets, wait_time)
+        with self.lock:
+            self.stripe_acquisitions[index] += 1
+            self.stripe_wait_histogram[index * (len(self.wait_buckets) + 1) + bucket] += 1
+            self.stripe_max_holders[index] = max(self.stripe_max_holders[index], n_holders)
+        with self.key_stats_lock:
+            key_stats = self.key_stats.get(key)
+            if key_stats is None:
+                if len(self.key_stats) >= self.max_tracked_keys:
+                    return
+                key_stats = {"acquisitions": 0, "wait_histogram": [0] * (len(self.wait_buckets) + 1), "total_wait": 0.0, "max_holders": 0}
+                self.key_stats[key] = key_stats
+            key_stats["acquisitions"] += 1
+            key_stats["wait_histogram"][bucket] += 1
+            key_stats["total_wait"] += wait_time
+            key_stats["max_holders"] = max(key_stats["max_holders"], n_holders)
+
+    @contextlib.contextmanager
+    def locked(self, key, timeout=None):
+        """
+        hold the lock of the key in with-statement, waiting for a free lock if the pool is exhausted
+        timeout: seconds to wait in total; None to wait forever
+        raise TimeoutError if the lock is not acquired in time
+        """
+        time_start = time.monotonic()
+        deadline = None if timeout is None else time_start + timeout
+        # get a lock from the pool
+        with self.cond:
+            while True:
+                index, n_holders = self._get_index(key)
+                if index is not None:
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("no free lock in the pool for {0}".format(key))
+                self.cond.wait(remaining)
+        lock = self.lock_pool[index]
+        # acquire the lock
+        try:
+            if deadline is None:
+                is_acquired = lock.acquire()
+            else:
+                is_acquired = lock.acquire(timeout=max(deadline - time.monotonic(), 0))
+        except BaseException:
+            self.release(key)
+            raise
+        if not is_acquired:
+            self.release(key)
+            raise TimeoutError("failed to acquire the lock for {0} in {1} sec".format(key, timeout))
+        self._record_stats(key, index, n_holders, time.monotonic() - time_start)
+        try:
+            yield lock
+        finally:
+            lock.release()
+            self.release(key)
+
+    def get_stats(self):
+        """
+        get contention statistics; wait histograms count waits up to each of wait_buckets seconds and beyond
+        return dict with "wait_buckets", "stripes" {lock index: stats} for all processes, and "keys" {key: stats} in this process
+        """
+        n_buckets = len(self.wait_buckets) + 1
+        stripes = {}
+        with self.lock:
+            for index in range(self.pool_size):
+                if self.stripe_acquisitions[index]:
+                    stripes[index] = {
+                        "acquisitions": self.stripe_acquisitions[index],
+                        "wait_histogram": self.stripe_wait_histogram[index * n_buckets : (index + 1) * n_buckets],
+                        "max_holders": self.stripe_max_holders[index],
+                        "holders": self.lock_ref_count[index],
+                    }
+        with self.key_stats_lock:
+            keys = {key: dict(key_stats, wait_histogram=list(key_stats["wait_histogram"])) for key, key_stats in self.key_stats.items()}
+        return {"wait_buckets": list(self.wait_buckets), "stripes": stripes, "keys": keys}
@@ -0,0 +1,40 @@
+import inspect
+import timeit
+
+from pandacommon.pandalogger import logger_utils
+from pandacommon.pandalogger.LogWrapper import LogWrapper
+
+# benchmark of logger creation cost per call without method_name
+
+base_logger = logger_utils.setup_logger("logger_bench")
+
+
+# old way to get the caller name
+def make_logger_with_stack(tmp_log, token=None):
+    tmp_str = inspect.stack()[1][3]
+    tmp_str += " <{0}>".format(token)
+    return LogWrapper(tmp_log, tmp_str)
+
+
+def caller_old():
+    return make_logger_with_stack(base_logger, token="bench")
+
+
+def caller_new():
+    return logger_utils.make_logger(base_logger, token="bench")
+
+
+# nest calls to mimic a deep stack in the server
+def nested(func, depth):
+    if depth == 0:
+        return func()
+    return nested(func, depth - 1)
+
+
+for depth in (0, 20):
+    for label, func in (("inspect.stack", caller_old), ("frame lookup", caller_new)):
+        n = 200 if label == "inspect.stack" else 20000
+        sec = timeit.timeit(lambda: nested(func, depth), number=n)
+        print("stack depth {0:2d} {1:14s}: {2:8.2f} usec per call".format(depth, label, sec / n * 1e6))
+
+assert caller_new().prefix == caller_old().prefix.replace("caller_old", "caller_new")
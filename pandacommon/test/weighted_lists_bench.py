@@ -0,0 +1,62 @@
+import multiprocessing
+import time
+
+from pandacommon.pandautils.thread_utils import (
+    LocalWeightedLists,
+    SharedWeightedLists,
+    WeightedLists,
+)
+
+# benchmark of weighted lists with 10^5 items in 1000 lists
+
+n_lists = 1000
+n_items_per_list = 100
+
+
+def fill(weighted_lists):
+    for i in range(n_lists):
+        weighted_lists.add(i % 10 + 1, ["job_{0}_{1}".format(i, j) for j in range(n_items_per_list)])
+
+
+def bench(label, weighted_lists, n_pops):
+    t_start = time.monotonic()
+    fill(weighted_lists)
+    t_add = time.monotonic() - t_start
+    t_start = time.monotonic()
+    for i in range(n_pops):
+        weighted_lists.pop()
+    t_pop = time.monotonic() - t_start
+    print(
+        "{0:20s}: add {1:8.2f} usec per item, pop {2:8.2f} usec per item, len {3}".format(
+            label, t_add / (n_lists * n_items_per_list) * 1e6, t_pop / n_pops * 1e6, len(weighted_lists)
+        )
+    )
+
+
+def pop_in_child(weighted_lists, n_pops, queue):
+    queue.put([weighted_lists.pop() for i in range(n_pops)])
+
+
+if __name__ == "__main__":
+    baseline = WeightedLists(None)
+    bench("WeightedLists", baseline, 100)
+    # discard items left in the queues of the baseline, otherwise its feeder threads block the exit
+    baseline.data.cancel_join_thread()
+    baseline.weights.cancel_join_thread()
+    bench("SharedWeightedLists", SharedWeightedLists(), n_lists * n_items_per_list)
+    bench("LocalWeightedLists", LocalWeightedLists(), n_lists * n_items_per_list)
+    # pop from several processes without duplication
+    weighted_lists = SharedWeightedLists()
+    fill(weighted_lists)
+    queue = multiprocessing.Queue()
+    n_procs = 4
+    n_pops = n_lists * n_items_per_list // n_procs
+    procs = [multiprocessing.Process(target=pop_in_child, args=(weighted_lists, n_pops, queue)) for i in range(n_procs)]
+    for proc in procs:
+        proc.start()
+    popped = []
+    for proc in procs:
+        popped += queue.get()
+    for proc in procs:
+        proc.join()
+    print("popped {0} unique items in {1} processes, {2} left".format(len(set(popped)), n_procs, len(weighted_lists)))